@@ -1,5 +1,4 @@
 import argparse
-import smbus
 import time
 import os
 import sys
@@ -9,9 +8,12 @@ from enum import Enum
 # Import dependancies
 from PIL import Image, ImageDraw, ImageFont
 from font_fredoka_one import FredokaOne
-from inky import eeprom
-from inky import phat
+from inkyDisplay import InkyConnect
 import PiSugar
+from frameGuard import FrameGuardClass
+from stageTimer import NULL_TIMER
+from registerMonitor import RegisterMonitorClass
+from batteryLog import BatteryLogClass, RegisterLogClass, BATTERY_LOG, REGISTER_LOG
 
 # Import secrets
 from secrets import Secrets
@@ -21,6 +23,7 @@ DEBUG = True
 
 # Get the current path
 PATH = os.path.dirname(__file__)
+CACHE = "/home/" + Secrets.username + "/.cache/Inky/"
 
 parser = argparse.ArgumentParser()
 parser.add_argument(
@@ -29,89 +32,160 @@ parser.add_argument(
     action='store_true',
     help="Display Battery information to the phat",
 )
-args = parser.parse_args()
+parser.add_argument(
+    "--interval",
+    default=2.0,
+    type=float,
+    help="Seconds between background battery samples in --display mode",
+)
+parser.add_argument(
+    "--poll",
+    default=60.0,
+    type=float,
+    help="Seconds between register dumps in --display mode",
+)
+parser.add_argument(
+    "--voltage-delta",
+    default=0.02,
+    type=float,
+    help="Voltage change (V) that triggers a refresh in --display mode",
+)
+parser.add_argument(
+    "--percent-delta",
+    default=1.0,
+    type=float,
+    help="Charge change (percent points) that triggers a refresh in --display mode",
+)
+parser.add_argument(
+    "--watch",
+    action="append",
+    help="Register (hex) whose changes trigger a refresh in --display mode, repeatable",
+)
+
+# Register dump layout: address, then 8 bytes per row, 6 rows cover 0x00-0x2F
+DUMP_COLUMNS = 8
+DUMP_ROWS = 6
+DUMP_LEFT = 42
+COLUMN_WIDTH = 25
+ROW_HEIGHT = 15
+
+# Registers whose changes always warrant a refresh: power control and timed bootup
+WATCHED = (0x02, 0x03, 0x20, 0x40)
+
+_font = None
+
+
+def loadFont():
+    """The FredokaOne font, loaded once per process."""
+    global _font
+    if _font is None:
+        _font = ImageFont.truetype(FredokaOne, 11)
+    return _font
+
+
+def renderBatteryScreen(display, voltage, perc, bd, timer=NULL_TIMER, changed=()):
+    """Draw the battery voltage and register dump screen.
+
+    Bytes listed in changed are drawn in red. Returns the image along with
+    the dump formatted as hex text.
+    """
+    # Blank canvas
+    img = Image.new("P", (250, 122), 0)
+    draw = ImageDraw.Draw(img)
+
+    # Load the FredokaOne font
+    with timer.stage("asset load"):
+        font = loadFont()
+    with timer.stage("text draw"):
+        draw.text((5, 10), "Battery: %.3f V | %.1f %%" % (voltage, perc), display.BLACK, font=font)
+        bufferString = ""
+        for byte in bd:
+            bufferString += "0x%02X " % byte
+        for i, byte in enumerate(list(bd)[:DUMP_COLUMNS * DUMP_ROWS]):
+            row, column = divmod(i, DUMP_COLUMNS)
+            if column == 0:
+                draw.text((5, 30 + row * ROW_HEIGHT), "0x%02X" % i, display.BLACK, font=font)
+            colour = display.RED if i in changed else display.BLACK
+            draw.text((DUMP_LEFT + column * COLUMN_WIDTH, 30 + row * ROW_HEIGHT), "%02X" % byte, colour, font=font)
+    return img, bufferString
+
+
+class ChangeMonitorClass:
+    """Decides when the live battery screen is worth an e-ink refresh.
+
+    Every poll is compared against what is currently on the panel, so slow
+    drifts still add up to a refresh eventually. A refresh is due when a
+    watched register changed, or the voltage or percentage moved by at
+    least their threshold since the last one.
+    """
+
+    def __init__(self, watched=WATCHED, voltageDelta=0.02, percentDelta=1.0):
+        self.watched = set(watched)
+        self.voltageDelta = voltageDelta
+        self.percentDelta = percentDelta
+        self.shown = None
+
+    def check(self, sample, dump):
+        """Return (refresh due, indices of the bytes that differ from the panel)."""
+        dump = list(dump)
+        if self.shown is None:
+            return True, set()
+        shownSample, shownDump = self.shown
+        changed = {i for i in range(min(len(dump), len(shownDump))) if dump[i] != shownDump[i]}
+        refresh = bool(changed & self.watched) \
+            or abs(sample.voltage - shownSample.voltage) >= self.voltageDelta \
+            or abs(sample.percent - shownSample.percent) >= self.percentDelta
+        return refresh, changed
+
+    def painted(self, sample, dump):
+        self.shown = (sample, list(dump))
 
 if __name__ == "__main__":
+    args = parser.parse_args()
     if args.display:
         def signalHandler(sig, frame):
             print("Process ended")
-            del PiSugar
-            if DEBUG:
-                fid.close()
+            # Deleting the global here made it a local, raising UnboundLocalError
+            PiSugar.stopSampler()
             sys.exit(0)
 
         signal.signal(signal.SIGINT, signalHandler)
 
-        def create_mask(self, source):
-            """Create a transparency mask.
-
-            Takes a paletized source image and converts it into a mask
-            permitting all the colours supported by Inky pHAT (0, 1, 2)
-            or an optional list of allowed colours.
-
-            :param mask: Optional list of Inky pHAT colours to allow.
-
-            """
-            mask=(display.WHITE, display.BLACK, display.RED)
-            mask_image = Image.new("1", source.size)
-            w, h = source.size
-            for x in range(w):
-                for y in range(h):
-                    p = source.getpixel((x, y))
-                    if p in mask:
-                        mask_image.putpixel((x, y), 255)
-
-            return mask_image
-
-        # Connect to the Inky Display
-        _eeprom = eeprom.read_eeprom()
-        if _eeprom is None:
-            raise RuntimeError("No EEPROM detected! You must manually initialise your Inky board.")
-        elif _eeprom.display_variant != 11:
-            if DEBUG:
-                print("Found eeprom id " + _eeprom.display_variant)
-            raise RuntimeError("Display is not the expected variant")
-
+        # Connect to the Inky Display, and sample the battery in the background
         PiSugar = PiSugar.PiSugarConnect()
-        display = phat.InkyPHAT_SSD1608("red")
+        PiSugar.startSampler(interval=args.interval)
+        display = FrameGuardClass(InkyConnect("red"), CACHE)
         try:
             display.set_border(display.BLACK)
         except NotImplementedError:
             pass
 
-        if DEBUG:
-            fid = open(os.path.join(PATH, "../LiveLogVoltage.csv"), "w")
+        registerLog = RegisterLogClass(REGISTER_LOG)
+        # Only the screen's registers and the decoded fields are read, not all 256
+        registers = RegisterMonitorClass(PiSugar, extraWindows=[(0, DUMP_COLUMNS * DUMP_ROWS)])
+        watched = [int(register, 16) for register in args.watch] if args.watch else WATCHED
+        monitor = ChangeMonitorClass(watched, args.voltage_delta, args.percent_delta)
 
         while True:
-            # Blank canvas
-            img = Image.new("P", (250, 122), 0)
-            draw = ImageDraw.Draw(img)
-
-            # Load the FredokaOne font
-            font = ImageFont.truetype(FredokaOne, 11)
-            draw.text((5, 10), "Battery: %.3f V | %.1f %%" % (PiSugar.getBatteryVoltage(), PiSugar.getBatteryPerc()), display.BLACK, font=font)
-            bd = PiSugar.buffDump()
-            bufferString = ""
-            for byte in bd:
-                bufferString += "0x%02X " % byte
-            draw.text((5, 30), bufferString[0:40], display.BLACK, font=font)
-            draw.text((5, 45), bufferString[40:80], display.BLACK, font=font)
-            draw.text((5, 60), bufferString[80:110], display.BLACK, font=font)
-            draw.text((185, 60), bufferString[110:120], display.RED, font=font)
-            draw.text((5, 75), bufferString[120:160], display.BLACK, font=font)
-            draw.text((5, 90), bufferString[160:200], display.BLACK, font=font)
-            draw.text((5, 105), bufferString[200:], display.BLACK, font=font)
+            sample = PiSugar.getSample()
+            for event in registers.poll():
+                if DEBUG:
+                    print("%s: %s -> %s" % (event.field, event.old, event.new))
+            dump = registers.image
             if DEBUG:
-                fid.write(time.strftime('%H:%M,') + bufferString.replace(" ", ","))
-
-            # Update Display
-            display.set_image(img)
-            display.show()
-
-            for i in range(0, 150):
-                time.sleep(2.0)
+                # Registers outside the monitor's windows are logged as unread
+                registerLog.append(sample, dump, registers.known)
+
+            # Only spend a refresh when something worth seeing changed
+            refresh, changed = monitor.check(sample, dump)
+            if refresh:
+                img, bufferString = renderBatteryScreen(display, sample.voltage, sample.percent, dump, changed=changed)
+                display.set_image(img)
+                display.show()
+                monitor.painted(sample, dump)
+
+            time.sleep(args.poll)
     else:
-        fid = open(os.path.join(PATH, "../LogVoltageV2.csv"), "a")
+        # One fixed size record per run, see batteryLog.py for CSV export
         PiSugar = PiSugar.PiSugarConnect()
-        fid.write(time.strftime('%m/%d/%Y %H:%M') + ",%i,%.3f,%.3f,%i," % (PiSugar.getBatteryBytes(), PiSugar.getBatteryVoltage(), PiSugar.getBatteryPerc(), PiSugar.getBatteryEnergy()) + str(PiSugar.isSuppliedPower()) + "\n")
-        fid.close()
+        BatteryLogClass(BATTERY_LOG).append(PiSugar.snapshot(samples=10))
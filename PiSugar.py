@@ -1,45 +1,142 @@
-import smbus
+try:
+    import smbus
+except ImportError:
+    smbus = None
 import time
 import os
 import math
+import threading
 from enum import Enum
+from datetime import datetime, timezone
+from collections import namedtuple
 
 # Import dependancies
 from PIL import Image, ImageDraw, ImageFont
 from font_fredoka_one import FredokaOne
-from inky import eeprom
-from inky import phat
+from inkyDisplay import InkyConnect
+from inkyMask import create_mask
+from batterySampler import BatterySamplerClass
+from batteryCurve import getBatteryCurve, CACHE
+from frameGuard import FrameGuardClass
+from fakeSMBus import ReplayBusClass, RecordingBusClass
 
 # Debug boolean
 DEBUG = True
 
-def PiSugarConnect():
-    # Open I2C connection
-    _i2cBus = smbus.SMBus(1)
+# One reading of the battery registers, shared by everyone who needs battery data
+BatterySample = namedtuple("BatterySample", ["timestamp", "raw", "voltage", "percent", "energy", "supplied", "temperature", "powerCtrl"])
+
+def voltageToPercent(voltage):
+    """
+    Returns percent of battery charge available
+
+    Shutdown voltage: ~ 3.0 V
+    Max Voltage:      ~ 4.2? V
+    ergo Battery range ~ 1.2 V from min to max
+
+    Current way to determine the battery percentage uses the following peacewise functions
+    for x <= 3.7: f(x)=150^(x-4.07)
+    for 3.7 < x <= 3.775: f(x)=20^(14x-53.3)+0.15
+    for 3.775 < x: -20^(-x+3.7)+1.2
+
+    Once batteryCurve.py has fitted a curve from the logged discharges,
+    that lookup table is used instead.
+    """
+    curve = getBatteryCurve()
+    if curve is not None:
+        return curve.percent(voltage)
+    if voltage <= 3.7:
+        return 100*150**(voltage-4.07)
+    elif voltage <= 3.775:
+        return 100*(20**(14*voltage-53.3)+0.15)
+    else:
+        return 100*(-(20**(-voltage+3.7))+1.2)
+
+def fromBCD(value):
+    return (value >> 4) * 10 + (value & 0x0F)
+
+def toBCD(value):
+    return ((value // 10) << 4) + value % 10
+
+def PiSugarConnect(bus=None):
+    """Connect to the PiSugar, over bus (an smbus.SMBus or a stand-in) if given.
+
+    Without a bus, PISUGAR_REPLAY in the environment names a recorded dump
+    to answer from (see fakeSMBus.py) instead of the hardware, and
+    PISUGAR_RECORD a file to log every transaction on the real bus to.
+    """
+    if bus is None and os.environ.get("PISUGAR_REPLAY"):
+        # Move on to the next recorded dump after each buffDump's worth of reads
+        bus = ReplayBusClass.fromFile(os.environ["PISUGAR_REPLAY"], transactionsPerFrame=8)
+    if bus is None:
+        if smbus is None:
+            print("Attention, no smbus module found!")
+            return PiDummy()
+
+        # Open I2C connection
+        bus = smbus.SMBus(1)
+        if os.environ.get("PISUGAR_RECORD"):
+            bus = RecordingBusClass(bus, os.environ["PISUGAR_RECORD"])
 
     try:
-        SugarID = _i2cBus.read_byte_data(0x57, 0)
+        SugarID = bus.read_byte_data(0x57, 0)
         if SugarID == 3:
-            return PiSugarClass(_i2cBus)
+            return PiSugarClass(bus)
+        print("Attention, unexpected PiSugar id %i!" % SugarID)
     except OSError as err:
         print("Attention, no PiSugar found!")
-        _i2cBus.close()
-        return PiDummy()
+    bus.close()
+    return PiDummy()
 
 class PiSugarClass:
     ADDRESS = 0x57
     Available = False
     _i2cBus = None
 
+    # SMBus block reads return at most 32 bytes, so 0x02-0x2A takes two
+    CONTROL_BLOCK = (0x02, 32)
+    BATTERY_BLOCK = (0x22, 9)
+    # Chip temperature is reported with a +40 degC offset
+    TEMPERATURE_OFFSET = 40
+    # Writing this to WriteProtect unlocks the rw registers, anything else locks them
+    WRITE_UNLOCK = 0x29
+    # The RTC and the bootup alarm keep UTC, like pisugar-server does
+    RTC_BLOCK = (0x31, 7)
+    BOOTUP_BLOCK = (0x44, 4)
+
     def __init__(self, bus):
         self._i2cBus = bus
+        self._busLock = threading.Lock()
+        self.sampler = None
         self.Available = True
 
     def __del__(self):
         # Close I2C connection
+        if self.sampler is not None:
+            self.sampler.stop()
         if self._i2cBus is not None:
             self._i2cBus.close()
 
+    def startSampler(self, interval=2.0, size=512):
+        """Poll the battery in the background, see BatterySamplerClass.
+
+        Once the first sample is in, the getters answer from the sampler's
+        filtered values instead of reading the bus.
+        """
+        if self.sampler is None:
+            self.sampler = BatterySamplerClass(self.snapshot, interval, size)
+        return self.sampler.start()
+
+    def stopSampler(self):
+        if self.sampler is not None:
+            self.sampler.stop()
+
+    def getSample(self, samples=10):
+        """The sampler's filtered sample when it has one, a fresh snapshot otherwise."""
+        if self.sampler is not None and self.sampler.count > 0:
+            return self.sampler.filtered()
+        return self.snapshot(samples)
+
     def isAvailable(self):
         return self.Available
 
@@ -53,53 +150,60 @@ class PiSugarClass:
             time.sleep(0.05)
         print(samples)
 
+    def snapshot(self, samples=1, interval=0.05):
+        """Read every battery register in block transactions and decode them.
+
+        The control registers (0x02-0x21) are read once, the battery block
+        (0x22-0x2A) samples times, interval seconds apart, with the voltage
+        and energy level averaged over those reads.
+
+        :param samples: Number of battery block reads to average.
+        :param interval: Seconds between battery block reads.
+
+        """
+        start, length = self.CONTROL_BLOCK
+        with self._busLock:
+            control = self._i2cBus.read_i2c_block_data(self.ADDRESS, start, length)
+        powerCtrl = control[self._registerMap.PowerCtrl.value - start]
+        temperature = control[self._registerMap.Temperature.value - start] - self.TEMPERATURE_OFFSET
+
+        start, length = self.BATTERY_BLOCK
+        raws = []
+        energies = []
+        for i in range(samples):
+            if i > 0:
+                time.sleep(interval)
+            with self._busLock:
+                battery = self._i2cBus.read_i2c_block_data(self.ADDRESS, start, length)
+            raws.append((battery[self._registerMap.BatteryUpper.value - start] << 8) + battery[self._registerMap.BatteryLower.value - start])
+            energies.append(battery[self._registerMap.EnergyLevel.value - start])
+
+        raw = raws[-1]
+        voltage = sum(raws) / len(raws) / 1007.0
+        return BatterySample(time.time(), raw, voltage, voltageToPercent(voltage), sum(energies) / len(energies), (powerCtrl & (1 << 7)) > 0, temperature, powerCtrl)
+
     def getBatteryBytes(self):
-        lowerByte = self._i2cBus.read_byte_data(self.ADDRESS, self._registerMap.BatteryLower.value)
-        upperByte = self._i2cBus.read_byte_data(self.ADDRESS, self._registerMap.BatteryUpper.value)
-        return (upperByte << 8) + lowerByte
+        return self.snapshot().raw
 
     def getBatteryVoltage(self):
-        samples = []
-        for i in range(0,10):
-            lowerByte = self._i2cBus.read_byte_data(self.ADDRESS, self._registerMap.BatteryLower.value)
-            upperByte = self._i2cBus.read_byte_data(self.ADDRESS, self._registerMap.BatteryUpper.value)
-            samples.append(((upperByte << 8) + lowerByte) / 1007.0)
-            time.sleep(0.05)
-        avg = sum(samples) / len(samples)
-        return avg
+        return self.getSample().voltage
 
     def getBatteryEnergy(self):
-        samples = []
-        for i in range(0,10):
-           samples.append(self._i2cBus.read_byte_data(self.ADDRESS, self._registerMap.EnergyLevel.value))
-           time.sleep(0.1)
-        return sum(samples) / len(samples)
+        return self.getSample().energy
 
     def getBatteryPerc(self):
-        """
-        Returns percent of battery charge available
-
-        Shutdown voltage: ~ 3.0 V
-        Max Voltage:      ~ 4.2? V
-        ergo Battery range ~ 1.2 V from min to max
-
-        Current way to determine the battery percentage uses the following peacewise functions
-        for x <= 3.7: f(x)=150^(x-4.07)
-        for 3.7 < x <= 3.775: f(x)=20^(14x-53.3)+0.15
-        for 3.775 < x: -20^(-x+3.7)+1.2
-        """
-        voltage = self.getBatteryVoltage()
-        if voltage <= 3.7:
-            return 100*150**(voltage-4.07)
-        elif voltage <= 3.775:
-            return 100*(20**(14*voltage-53.3)+0.15)
-        else:
-            return 100*(-(20**(-voltage+3.7))+1.2)
+        """Returns percent of battery charge available, see voltageToPercent."""
+        return self.getSample().percent
 
     def isSuppliedPower(self):
-        PowerCtrlReg = self._i2cBus.read_byte_data(self.ADDRESS, self._registerMap.PowerCtrl.value)
-        extPower = (PowerCtrlReg & (1 << 7)) > 0
-        return extPower
+        return self.snapshot().supplied
+
+    def getRemainingRuntime(self):
+        """Estimated seconds until the battery is flat, None without a fitted curve."""
+        curve = getBatteryCurve()
+        if curve is None:
+            return None
+        return curve.remaining(self.getSample().percent)
 
     def create_mask(self, source):
         """Create a transparency mask.
@@ -112,20 +216,111 @@ class PiSugarClass:
 
         """
 
+    def readWindow(self, start, length):
+        """Read up to 32 consecutive registers in one transaction."""
+        with self._busLock:
+            return self._i2cBus.read_i2c_block_data(self.ADDRESS, start, length)
+
+    def writeRegisters(self, values):
+        """Write (register, value) pairs with the write protection lifted.
+
+        The protection is put back afterwards, even if a write fails.
+        """
+        with self._busLock:
+            self._i2cBus.write_byte_data(self.ADDRESS, self._registerMap.WriteProtect.value, self.WRITE_UNLOCK)
+            try:
+                for register, value in values:
+                    self._i2cBus.write_byte_data(self.ADDRESS, register, value)
+            finally:
+                self._i2cBus.write_byte_data(self.ADDRESS, self._registerMap.WriteProtect.value, 0x00)
+
+    def getRTC(self):
+        """Read the PiSugar's clock as an aware UTC datetime."""
+        start, length = self.RTC_BLOCK
+        regs = [fromBCD(value) for value in self.readWindow(start, length)]
+        year, month, day, weekday, hour, minute, second = regs
+        return datetime(2000 + year, month, day, hour, minute, second, tzinfo=timezone.utc)
+
+    def setRTC(self, when=None):
+        """Set the PiSugar's clock, to the system time if when is omitted."""
+        if when is None:
+            when = datetime.now(timezone.utc)
+        when = when.astimezone(timezone.utc)
+        regs = (when.year - 2000, when.month, when.day, when.isoweekday() % 7, when.hour, when.minute, when.second)
+        self.writeRegisters(zip(range(self.RTC_BLOCK[0], self.RTC_BLOCK[0] + self.RTC_BLOCK[1]), [toBCD(reg) for reg in regs]))
+
+    def getTimedBootup(self):
+        """Return (enabled, weekday mask, hour, minute, second) of the bootup alarm.
+
+        The time is UTC, bit n of the mask is weekday n counting from Sunday.
+        """
+        enabled = (self.readWindow(self._registerMap.TimedBootup.value, 1)[0] & (1 << 7)) > 0
+        start, length = self.BOOTUP_BLOCK
+        weekdays, hour, minute, second = self.readWindow(start, length)
+        return enabled, weekdays & 0x7F, fromBCD(hour), fromBCD(minute), fromBCD(second)
+
+    def setTimedBootup(self, when, weekdays=None):
+        """Power the Pi back on at when's time of day (a datetime).
+
+        :param when: Time to boot, converted to UTC.
+        :param weekdays: Weekday mask (bit 0 is Sunday), defaults to when's day only.
+
+        """
+        when = when.astimezone(timezone.utc)
+        if weekdays is None:
+            weekdays = 1 << (when.isoweekday() % 7)
+        control = self.readWindow(self._registerMap.TimedBootup.value, 1)[0]
+        self.writeRegisters([
+            (self._registerMap.Boot_Weekday.value, weekdays & 0x7F),
+            (self._registerMap.Boot_Hour.value, toBCD(when.hour)),
+            (self._registerMap.Boot_Minute.value, toBCD(when.minute)),
+            (self._registerMap.Boot_Second.value, toBCD(when.second)),
+            (self._registerMap.TimedBootup.value, control | (1 << 7)),
+        ])
+
+    def disableTimedBootup(self):
+        control = self.readWindow(self._registerMap.TimedBootup.value, 1)[0]
+        self.writeRegisters([(self._registerMap.TimedBootup.value, control & ~(1 << 7) & 0xFF)])
+
+    def delayedShutdown(self, seconds):
+        """Have the PiSugar cut the power seconds from now, e.g. once the Pi has halted."""
+        control = self.readWindow(self._registerMap.PowerCtrl.value, 1)[0]
+        self.writeRegisters([
+            (self._registerMap.ShutdownTime.value, min(255, max(0, int(seconds)))),
+            (self._registerMap.PowerCtrl.value, control | (1 << 5)),
+        ])
+
     def buffDump(self):
         buffer = []
         for i in range(0, 256, 32):
-            word = self._i2cBus.read_i2c_block_data(0x57, i, 32)
+            with self._busLock:
+                word = self._i2cBus.read_i2c_block_data(0x57, i, 32)
             buffer.extend(word)
             time.sleep(0.1)
         return buffer
 
     class _registerMap(Enum):
         PowerCtrl    = 0x02
+        PowerCtrl2   = 0x03
         Temperature  = 0x04
+        ShutdownTime = 0x09
+        WriteProtect = 0x0B
+        ChargeCtrl   = 0x20
         BatteryUpper = 0x22
         BatteryLower = 0x23
         EnergyLevel  = 0x2A
+        RTC_Year     = 0x31
+        RTC_Month    = 0x32
+        RTC_Day      = 0x33
+        RTC_Weekday  = 0x34
+        RTC_Hour     = 0x35
+        RTC_Minute   = 0x36
+        RTC_Second   = 0x37
+        TimedBootup  = 0x40
+        Boot_Weekday = 0x44
+        Boot_Hour    = 0x45
+        Boot_Minute  = 0x46
+        Boot_Second  = 0x47
         FW_Version_0 = 0xE2
         FW_Version_1 = 0xE3
         FW_Version_2 = 0xE4
@@ -240,30 +435,49 @@ class PiDummy:
     def isAvailable(self):
         return False
 
+    def snapshot(self, samples=1, interval=0.05):
+        return BatterySample(time.time(), 0, 0.0, 0, 0, False, 0, 0)
+
+    def getSample(self, samples=10):
+        return self.snapshot()
+
+    def startSampler(self, interval=2.0, size=512):
+        return None
+
+    def stopSampler(self):
+        pass
+
     def getBatteryVoltage(self):
         return 0.0
 
     def getBatteryPerc(self):
         return 0
 
+    def getRemainingRuntime(self):
+        return None
+
     def buffDump(self):
         return range(0, 256*32)
 
+    def readWindow(self, start, length):
+        return [0] * length
+
+    def getRTC(self):
+        return None
+
+    def setTimedBootup(self, when, weekdays=None):
+        pass
+
+    def disableTimedBootup(self):
+        pass
+
 if __name__ == "__main__":
     # Get the current path
     PATH = os.path.dirname(__file__)
 
 
     # Connect to the Inky Display
-    _eeprom = eeprom.read_eeprom()
-    if _eeprom is None:
-        raise RuntimeError("No EEPROM detected! You must manually initialise your Inky board.")
-    elif _eeprom.display_variant != 11:
-        if DEBUG:
-            print("Found eeprom id " + _eeprom.display_variant)
-        raise RuntimeError("Display is not the expected variant")
-
-    display = phat.InkyPHAT_SSD1608("red")
+    display = FrameGuardClass(InkyConnect("red"), CACHE)
     PiSugar = PiSugarConnect()
 
     try:
@@ -275,7 +489,8 @@ if __name__ == "__main__":
     draw = ImageDraw.Draw(img)
 
     # Add Battery icon & number
-    battPerc = PiSugar.getBatteryPerc()
+    sample = PiSugar.snapshot(samples=10)
+    battPerc = sample.percent
     if battPerc > 80.0:
         battIcon = Image.open(os.path.join(PATH, "resources/icons/system/Battery4.png"))
     elif battPerc > 60.0:
@@ -288,22 +503,15 @@ if __name__ == "__main__":
         battIcon = Image.open(os.path.join(PATH, "resources/icons/system/BatteryEmpty.png"))
 
     # Create Mask
-    mask=(display.WHITE, display.BLACK, display.RED)
-    mask_image = Image.new("1", battIcon.size)
-    w, h = battIcon.size
-    for x in range(w):
-        for y in range(h):
-            p = battIcon.getpixel((x, y))
-            if p in mask:
-                mask_image.putpixel((x, y), 255)
+    mask_image = create_mask(battIcon, (display.WHITE, display.BLACK, display.RED))
     img.paste(battIcon, (190, 1), mask_image)
 
 
     # Load the FredokaOne font
     font = ImageFont.truetype(FredokaOne, 22)
     draw.text((38, 14), "Battery:", display.WHITE, font=font)
-    draw.text((38, 43), "%.3f V" % PiSugar.getBatteryVoltage(), display.WHITE, font=font)
-    draw.text((38, 72), "%.1f %%" % PiSugar.getBatteryPerc(), display.WHITE, font=font)
+    draw.text((38, 43), "%.3f V" % sample.voltage, display.WHITE, font=font)
+    draw.text((38, 72), "%.1f %%" % sample.percent, display.WHITE, font=font)
 
     # display the battery information on Inky pHAT
     display.set_image(img)
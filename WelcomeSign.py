@@ -3,8 +3,9 @@ import os
 # Import dependancies
 from PIL import Image, ImageDraw, ImageFont
 from font_fredoka_one import FredokaOne
-from inky import eeprom
-from inky import phat
+from inkyDisplay import InkyConnect
+from frameGuard import FrameGuardClass
+from stageTimer import NULL_TIMER
 
 # Import secrets
 from secrets import Secrets
@@ -14,25 +15,25 @@ DEBUG = True
 
 # Get the current path
 PATH = os.path.dirname(__file__)
+CACHE = "/home/" + Secrets.username + "/.cache/Inky/"
+
+def getWelcomeImage(display, timer=NULL_TIMER):
+    with timer.stage("asset load"):
+        img = Image.open(os.path.join(PATH, "resources/Welcome_Black+Red_V2.png"))
+        img.load()
+    with timer.stage("resize"):
+        return img.resize(display.resolution)
 
 if __name__ == "__main__":
 
     # Connect to the Inky Display
-    _eeprom = eeprom.read_eeprom()
-    if _eeprom is None:
-        raise RuntimeError("No EEPROM detected! You must manually initialise your Inky board.")
-    elif _eeprom.display_variant != 11:
-        if DEBUG:
-            print("Found eeprom id " + _eeprom.display_variant)
-        raise RuntimeError("Display is not the expected variant")
-
-    display = phat.InkyPHAT_SSD1608("red")
+    display = FrameGuardClass(InkyConnect("red"), CACHE)
 
     try:
         display.set_border(display.RED)
     except NotImplementedError:
         pass
 
-    img = Image.open(os.path.join(PATH, "resources/Welcome_Black+Red_V2.png")).resize(display.resolution)
+    img = getWelcomeImage(display)
     display.set_image(img)
     display.show()
@@ -0,0 +1,209 @@
+import os
+import csv
+import json
+import time
+import argparse
+from bisect import bisect_right
+
+# Import dependancies
+import numpy
+
+# Import secrets
+from secrets import Secrets
+from batteryLog import BatteryLogClass, BATTERY_LOG
+
+# Get the current path
+PATH = os.path.dirname(__file__)
+CACHE = "/home/" + Secrets.username + "/.cache/Inky/"
+
+
+class BatteryCurveClass:
+    """Voltage to percent lookup table, fitted from logged discharges.
+
+    The table is a list of increasing voltages and the non-decreasing
+    charge left at each of them. Lookups interpolate linearly between the
+    two surrounding entries, so no exponentials are evaluated at run time.
+    runtime is how long a full charge lasted on average while logging,
+    used to turn a percentage into an estimate of the time left.
+    """
+
+    FILE_NAME = "batteryCurve.json"
+
+    def __init__(self, volts, percents, runtime=None):
+        self.volts = [float(volt) for volt in volts]
+        self.percents = [float(percent) for percent in percents]
+        self.runtime = runtime
+
+    @classmethod
+    def load(cls, cacheDir=CACHE):
+        """Load the saved curve, or None if calibrate hasn't been run."""
+        try:
+            with open(os.path.join(cacheDir, cls.FILE_NAME), "r") as curveFid:
+                curve = json.load(curveFid)
+            return cls(curve["volts"], curve["percents"], curve.get("runtime"))
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def save(self, cacheDir=CACHE):
+        os.makedirs(cacheDir, exist_ok=True)
+        path = os.path.join(cacheDir, self.FILE_NAME)
+        with open(path + ".tmp", "w") as curveFid:
+            json.dump({"volts": self.volts, "percents": self.percents, "runtime": self.runtime}, curveFid, indent=1)
+        os.replace(path + ".tmp", path)
+
+    def percent(self, voltage):
+        i = bisect_right(self.volts, voltage)
+        if i == 0:
+            return self.percents[0]
+        if i == len(self.volts):
+            return self.percents[-1]
+        v0, v1 = self.volts[i - 1], self.volts[i]
+        p0, p1 = self.percents[i - 1], self.percents[i]
+        return p0 + (voltage - v0) * (p1 - p0) / (v1 - v0)
+
+    def remaining(self, percent):
+        """Estimated seconds of runtime left at a charge percentage, None if unknown."""
+        if self.runtime is None:
+            return None
+        return max(0.0, percent) / 100 * self.runtime
+
+
+_curve = None
+
+
+def getBatteryCurve():
+    """Return the saved curve, loaded once per process, or None."""
+    global _curve
+    if _curve is None:
+        _curve = BatteryCurveClass.load() or False
+    return _curve or None
+
+
+def readLog(path=BATTERY_LOG):
+    """Read a battery log into (times, voltages, supplied) arrays.
+
+    Takes the binary log of Logging.py, or an old LogVoltageV2.csv whose
+    rows are: date, raw bytes, voltage, percent, energy level, external power.
+    """
+    if path.endswith(".bin"):
+        records = BatteryLogClass(path).query()
+        order = numpy.argsort(records["timestamp"], kind="stable")
+        return records["timestamp"][order].astype(float), records["voltage"][order].astype(float), records["supplied"][order].astype(bool)
+
+    times = []
+    volts = []
+    supplied = []
+    with open(path, "r", newline="") as logFid:
+        for row in csv.reader(logFid):
+            try:
+                times.append(time.mktime(time.strptime(row[0], "%m/%d/%Y %H:%M")))
+                volts.append(float(row[2]))
+                supplied.append(row[5].strip() == "True")
+            except (IndexError, ValueError):
+                continue
+    order = numpy.argsort(times, kind="stable")
+    return numpy.array(times)[order], numpy.array(volts)[order], numpy.array(supplied, dtype=bool)[order]
+
+
+# Below this the last reading before the log went quiet means the battery ran flat
+EMPTY_VOLTAGE = 3.4
+# A rested battery reads up to this much higher than before a planned power off
+RECOVERY_VOLTAGE = 0.1
+
+
+def activeTime(times, maxGap=3600):
+    """Seconds the Pi had been running at each log entry, gaps over maxGap (powered off) left out."""
+    steps = numpy.diff(times)
+    steps[steps > maxGap] = 0
+    return numpy.concatenate(([0.0], numpy.cumsum(steps)))
+
+
+def dischargeRuns(times, supplied, volts, maxGap=3600, minDuration=3600, emptyVoltage=EMPTY_VOLTAGE):
+    """Return (start, end) index pairs of discharges that ran the battery flat.
+
+    A run is a stretch of unpowered log entries. Gaps of more than maxGap
+    seconds within it where the battery picks up where it left off are
+    planned power offs (powerSchedule.py) and don't end the run. A run
+    only counts when the log then goes quiet for good, rather than the
+    charger being plugged in, and its last voltage is at most
+    emptyVoltage, i.e. the Pi died instead of sleeping until its next
+    refresh.
+    """
+    breaks = numpy.flatnonzero(supplied[1:] != supplied[:-1]) + 1
+    gaps = numpy.flatnonzero(numpy.diff(times) > maxGap) + 1
+    # A battery that came back charged wasn't just asleep
+    gaps = gaps[supplied[gaps] | (volts[gaps] > volts[gaps - 1] + RECOVERY_VOLTAGE)]
+    edges = numpy.unique(numpy.concatenate(([0], breaks, gaps, [len(times)])))
+
+    runs = []
+    for start, end in zip(edges[:-1], edges[1:]):
+        if supplied[start] or end == len(times):
+            continue
+        duration = activeTime(times[start:end], maxGap)[-1]
+        if times[end] - times[end - 1] > maxGap and duration >= minDuration and volts[end - 1] <= emptyVoltage:
+            runs.append((start, end))
+    return runs
+
+
+def monotone(values, weights):
+    """Weighted pool adjacent violators: the closest non-decreasing sequence."""
+    blocks = []
+    for value, weight in zip(values, weights):
+        blocks.append([value, weight, 1])
+        while len(blocks) > 1 and blocks[-2][0] > blocks[-1][0]:
+            value, weight, count = blocks.pop()
+            blocks[-1][0] = (blocks[-1][0] * blocks[-1][1] + value * weight) / (blocks[-1][1] + weight)
+            blocks[-1][1] += weight
+            blocks[-1][2] += count
+    return numpy.repeat([block[0] for block in blocks], [block[2] for block in blocks])
+
+
+def fitCurve(times, volts, supplied, bins=48, emptyVoltage=EMPTY_VOLTAGE):
+    """Fit a BatteryCurveClass from log arrays.
+
+    Within each complete discharge the charge left is taken as the share
+    of the run's running time still to go (the Pi draws a near constant
+    current, and next to nothing while powered off).
+    Those points are averaged into voltage bins and made monotone.
+    """
+    runs = dischargeRuns(times, supplied, volts, emptyVoltage=emptyVoltage)
+    if not runs:
+        raise ValueError("No complete discharge in the log")
+
+    runVolts = []
+    runPercents = []
+    durations = []
+    for start, end in runs:
+        active = activeTime(times[start:end])
+        duration = active[-1]
+        runVolts.append(volts[start:end])
+        runPercents.append(100 * (duration - active) / duration)
+        durations.append(duration)
+    runVolts = numpy.concatenate(runVolts)
+    runPercents = numpy.concatenate(runPercents)
+
+    edges = numpy.linspace(runVolts.min(), runVolts.max(), bins + 1)
+    index = numpy.clip(numpy.digitize(runVolts, edges) - 1, 0, bins - 1)
+    counts = numpy.bincount(index, minlength=bins)
+    sums = numpy.bincount(index, weights=runPercents, minlength=bins)
+    used = counts > 0
+    centers = (edges[:-1] + edges[1:])[used] / 2
+    percents = monotone(sums[used] / counts[used], counts[used])
+    return BatteryCurveClass(centers, numpy.clip(percents, 0, 100), float(numpy.median(durations)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fit the voltage to percent curve from logged discharges")
+    parser.add_argument("--log", default=BATTERY_LOG, help="battery log (or old LogVoltageV2.csv) to fit")
+    parser.add_argument("--bins", type=int, default=48, help="Voltage steps in the table")
+    parser.add_argument("--empty-voltage", type=float, default=EMPTY_VOLTAGE, help="Highest last voltage of a run that ran the battery flat")
+    parser.add_argument("--dry-run", action="store_true", help="Print the table without saving it")
+    args = parser.parse_args()
+
+    curve = fitCurve(*readLog(args.log), bins=args.bins, emptyVoltage=args.empty_voltage)
+    for volt, percent in zip(curve.volts, curve.percents):
+        print("%.3f V  %5.1f %%" % (volt, percent))
+    print("Full charge lasts %.1f h" % (curve.runtime / 3600))
+    if not args.dry_run:
+        curve.save()
+        print("Saved to %s" % os.path.join(CACHE, BatteryCurveClass.FILE_NAME))
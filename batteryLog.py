@@ -0,0 +1,280 @@
+import os
+import csv
+import sys
+import time
+import struct
+import argparse
+
+# Import dependancies
+import numpy
+
+# Get the current path
+PATH = os.path.dirname(__file__)
+
+
+class BatteryLogClass:
+    """Append-only log of fixed size binary battery records.
+
+    The file is a short header (magic, record size) followed by packed
+    little endian records in time order, so a whole file can be memory
+    mapped as a NumPy structured array and a time range found with a
+    binary search, without parsing any text. Once a file would grow past
+    maxBytes it is rotated to <path>.1, <path>.2, ... keeping keep files.
+    """
+
+    MAGIC = b"IBL1"
+    HEADER = struct.Struct("<4sI8x")
+    DTYPE = numpy.dtype([
+        ("timestamp", "<f8"),
+        ("raw", "<u2"),
+        ("voltage", "<f4"),
+        ("percent", "<f4"),
+        ("energy", "<f4"),
+        ("supplied", "u1"),
+        ("temperature", "i1"),
+        ("powerCtrl", "u1"),
+    ])
+    MAX_BYTES = 1024 * 1024
+    KEEP = 8
+
+    def __init__(self, path, maxBytes=MAX_BYTES, keep=KEEP):
+        self.path = path
+        self.maxBytes = maxBytes
+        self.keep = keep
+
+    def files(self):
+        """Existing log files, oldest first."""
+        paths = ["%s.%i" % (self.path, i) for i in range(self.keep - 1, 0, -1)] + [self.path]
+        return [path for path in paths if os.path.isfile(path)]
+
+    def rotate(self):
+        for i in range(self.keep - 1, 0, -1):
+            older = "%s.%i" % (self.path, i)
+            newer = self.path if i == 1 else "%s.%i" % (self.path, i - 1)
+            if os.path.isfile(newer):
+                os.replace(newer, older)
+
+    def _header(self):
+        return self.HEADER.pack(self.MAGIC, self.DTYPE.itemsize)
+
+    def _readHeader(self, path):
+        with open(path, "rb") as logFid:
+            return self.HEADER.unpack(logFid.read(self.HEADER.size))
+
+    def appendRecords(self, records):
+        """Append a structured array (or list of tuples) of records."""
+        data = numpy.asarray(records, dtype=self.DTYPE).tobytes()
+        if os.path.isfile(self.path):
+            if os.path.getsize(self.path) + len(data) > self.maxBytes:
+                self.rotate()
+            elif os.path.getsize(self.path) >= self.HEADER.size and self._readHeader(self.path) != (self.MAGIC, self.DTYPE.itemsize):
+                # Never append to a file of an older layout, start a new one instead
+                self.rotate()
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(self.path, "ab") as logFid:
+            size = logFid.tell()
+            if size == 0:
+                logFid.write(self._header())
+            elif (size - self.HEADER.size) % self.DTYPE.itemsize:
+                # Drop a record torn by a power cut, it would misalign all later ones
+                logFid.truncate(size - (size - self.HEADER.size) % self.DTYPE.itemsize)
+                logFid.seek(0, os.SEEK_END)
+            logFid.write(data)
+
+    def insertRecords(self, records):
+        """Add records that may be older than the logged ones, keeping the file in time order.
+
+        Records all newer than the current file are appended, others are
+        merged with the current file's records and the file is rewritten.
+        """
+        records = numpy.asarray(records, dtype=self.DTYPE)
+        records = records[numpy.argsort(records["timestamp"], kind="stable")]
+        current = numpy.zeros(0, dtype=self.DTYPE)
+        if os.path.isfile(self.path) and os.path.getsize(self.path) >= self.HEADER.size:
+            current = numpy.array(self.mapFile(self.path))
+        if len(records) == 0 or len(current) == 0 or records["timestamp"][0] >= current["timestamp"][-1]:
+            self.appendRecords(records)
+            return
+
+        merged = numpy.concatenate((current, records))
+        merged = merged[numpy.argsort(merged["timestamp"], kind="stable")]
+        tmpFile = self.path + ".tmp"
+        with open(tmpFile, "wb") as logFid:
+            logFid.write(self._header())
+            logFid.write(merged.tobytes())
+        os.replace(tmpFile, self.path)
+
+    def append(self, sample):
+        """Append one PiSugar BatterySample."""
+        self.appendRecords([(sample.timestamp, sample.raw, sample.voltage, sample.percent, sample.energy, sample.supplied, sample.temperature, sample.powerCtrl)])
+
+    def mapFile(self, path):
+        """Memory map one log file as a read-only structured array."""
+        magic, itemsize = self._readHeader(path)
+        if magic != self.MAGIC or itemsize != self.DTYPE.itemsize:
+            raise ValueError("%s is not a %s file" % (path, type(self).__name__))
+        count = (os.path.getsize(path) - self.HEADER.size) // itemsize
+        if count == 0:
+            return numpy.zeros(0, dtype=self.DTYPE)
+        return numpy.memmap(path, dtype=self.DTYPE, mode="r", offset=self.HEADER.size, shape=(count,))
+
+    def query(self, start=None, end=None):
+        """Return the records with start <= timestamp < end, oldest first."""
+        parts = []
+        for path in self.files():
+            records = self.mapFile(path)
+            if len(records) == 0:
+                continue
+            first = 0 if start is None else numpy.searchsorted(records["timestamp"], start, "left")
+            last = len(records) if end is None else numpy.searchsorted(records["timestamp"], end, "left")
+            if first < last:
+                parts.append(numpy.array(records[first:last]))
+        if not parts:
+            return numpy.zeros(0, dtype=self.DTYPE)
+        # Imports can put older records in a newer file
+        records = numpy.concatenate(parts)
+        return records[numpy.argsort(records["timestamp"], kind="stable")]
+
+    def csvRow(self, record):
+        # Same columns as the old LogVoltageV2.csv, so existing tools keep working
+        return [time.strftime("%m/%d/%Y %H:%M", time.localtime(record["timestamp"])), "%i" % record["raw"], "%.3f" % record["voltage"], "%.3f" % record["percent"], "%i" % record["energy"], str(bool(record["supplied"]))]
+
+    def exportCsv(self, outFid, start=None, end=None):
+        writer = csv.writer(outFid, lineterminator="\n")
+        records = self.query(start, end)
+        for record in records:
+            writer.writerow(self.csvRow(record))
+        return len(records)
+
+    def importCsv(self, path):
+        """Append the rows of an old LogVoltageV2.csv, returns how many."""
+        records = []
+        with open(path, "r", newline="") as csvFid:
+            for row in csv.reader(csvFid):
+                try:
+                    stamp = time.mktime(time.strptime(row[0], "%m/%d/%Y %H:%M"))
+                    records.append((stamp, int(row[1]), float(row[2]), float(row[3]), float(row[4]), row[5].strip() == "True", 0, 0))
+                except (IndexError, ValueError):
+                    continue
+        if records:
+            self.insertRecords(records)
+        return len(records)
+
+
+class RegisterLogClass(BatteryLogClass):
+    """Battery log variant holding a 256 byte register image of each reading.
+
+    Not every register is read on every poll, so each record carries a
+    bit mask (bit n of byte n // 8) of the registers its dump really holds.
+    The unread ones are zero in the dump and "--" in the CSV export. Files
+    of the older full dump layout are still read, as fully read records.
+    """
+
+    MAGIC = b"IRL2"
+    DTYPE = numpy.dtype([
+        ("timestamp", "<f8"),
+        ("voltage", "<f4"),
+        ("percent", "<f4"),
+        ("dump", "u1", (256,)),
+        ("read", "u1", (32,)),
+    ])
+    LEGACY_MAGIC = b"IRL1"
+    LEGACY_DTYPE = numpy.dtype([
+        ("timestamp", "<f8"),
+        ("voltage", "<f4"),
+        ("percent", "<f4"),
+        ("dump", "u1", (256,)),
+    ])
+    MAX_BYTES = 4 * 1024 * 1024
+    KEEP = 4
+
+    @staticmethod
+    def readMask(registers=None):
+        """Pack the register addresses read (all of them if None) into a record's read mask."""
+        bits = numpy.ones(256, dtype=bool) if registers is None else numpy.isin(numpy.arange(256), list(registers))
+        return numpy.packbits(bits, bitorder="little")
+
+    @staticmethod
+    def readRegisters(record):
+        """Boolean array of the registers a record's dump really holds."""
+        return numpy.unpackbits(record["read"], bitorder="little").astype(bool)
+
+    def append(self, sample, dump, registers=None):
+        """Append one reading, registers being the addresses of dump that were read (all if None)."""
+        dump = list(dump)[:256]
+        self.appendRecords([(sample.timestamp, sample.voltage, sample.percent, dump + [0] * (256 - len(dump)), self.readMask(registers))])
+
+    def mapFile(self, path):
+        magic, itemsize = self._readHeader(path)
+        if magic != self.LEGACY_MAGIC or itemsize != self.LEGACY_DTYPE.itemsize:
+            return super().mapFile(path)
+        count = (os.path.getsize(path) - self.HEADER.size) // itemsize
+        records = numpy.zeros(count, dtype=self.DTYPE)
+        if count:
+            legacy = numpy.memmap(path, dtype=self.LEGACY_DTYPE, mode="r", offset=self.HEADER.size, shape=(count,))
+            for field in self.LEGACY_DTYPE.names:
+                records[field] = legacy[field]
+        records["read"] = self.readMask()
+        return records
+
+    def csvRow(self, record):
+        read = self.readRegisters(record)
+        return [time.strftime("%m/%d/%Y %H:%M", time.localtime(record["timestamp"])), "%.3f" % record["voltage"], "%.3f" % record["percent"]] + ["0x%02X" % byte if known else "--" for byte, known in zip(record["dump"], read)]
+
+    def importCsv(self, path):
+        """Append the dumps of an old LiveLogVoltage.csv or of an export, returns how many.
+
+        The old log only has HH:MM stamps, its last dump is dated by the
+        file's modification time and every earlier one on the same day or
+        the one before, whichever keeps the dumps in order.
+        """
+        # Imported here, both of them import this module
+        from fakeSMBus import loadStampedDumps
+        from PiSugar import voltageToPercent
+
+        with open(path, "r") as csvFid:
+            dumps = loadStampedDumps(csvFid.read())
+
+        records = []
+        day = time.localtime(os.path.getmtime(path))[:3]
+        later = None
+        for stamp, dump in reversed(dumps):
+            try:
+                if stamp is not None and "/" in stamp:
+                    stamped = time.mktime(time.strptime(stamp, "%m/%d/%Y %H:%M"))
+                else:
+                    stamped = time.mktime(time.strptime("%04i-%02i-%02i %s" % (day + (stamp or "00:00",)), "%Y-%m-%d %H:%M"))
+                    if later is not None and stamped > later:
+                        stamped -= 86400
+            except ValueError:
+                continue
+            day = time.localtime(stamped)[:3]
+            later = stamped
+            dump = (dump + [None] * 256)[:256]
+            registers = [register for register, byte in enumerate(dump) if byte is not None]
+            dump = [byte or 0 for byte in dump]
+            voltage = ((dump[0x22] << 8) + dump[0x23]) / 1007.0
+            records.append((stamped, voltage, voltageToPercent(voltage), dump, self.readMask(registers)))
+        if records:
+            self.insertRecords(records)
+        return len(records)
+
+
+BATTERY_LOG = os.path.join(PATH, "../batteryLog.bin")
+REGISTER_LOG = os.path.join(PATH, "../registerLog.bin")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Query, export or import the binary battery logs")
+    parser.add_argument("--registers", action="store_true", help="use the register dump log of Logging.py --display")
+    parser.add_argument("--since", type=float, default=None, help="only records from the last SINCE hours")
+    parser.add_argument("--import-csv", metavar="CSV", help="append an old LogVoltageV2.csv to the battery log (LiveLogVoltage.csv with --registers)")
+    args = parser.parse_args()
+
+    log = RegisterLogClass(REGISTER_LOG) if args.registers else BatteryLogClass(BATTERY_LOG)
+    if args.import_csv:
+        print("Imported %i rows" % log.importCsv(args.import_csv), file=sys.stderr)
+    else:
+        start = None if args.since is None else time.time() - 3600 * args.since
+        log.exportCsv(sys.stdout, start)
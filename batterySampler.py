@@ -0,0 +1,128 @@
+import time
+import threading
+from array import array
+from statistics import median
+
+
+class BatterySamplerClass:
+    """Polls a battery in the background into a fixed size ring buffer.
+
+    A daemon thread calls source (e.g. PiSugarClass.snapshot) every
+    interval seconds and stores the numeric fields of each sample in
+    preallocated arrays, overwriting the oldest entries once full. Readers
+    never touch the bus: get returns an exponential moving average (or the
+    median of the last few samples) straight from memory, along with the
+    age of the newest sample it is based on.
+
+    Usage::
+
+        sampler = BatterySamplerClass(PiSugar.snapshot, interval=2.0)
+        sampler.start()
+        voltage, age = sampler.get("voltage")
+    """
+
+    FIELDS = ("voltage", "percent", "energy", "temperature")
+    # Weight of the newest sample in the moving average
+    ALPHA = 0.2
+    # Samples in the median window
+    MEDIAN_WINDOW = 9
+
+    def __init__(self, source, interval=2.0, size=512, alpha=ALPHA):
+        self.source = source
+        self.interval = interval
+        self.size = size
+        self.alpha = alpha
+        self.times = array("d", bytes(8 * size))
+        self.values = {field: array("f", bytes(4 * size)) for field in self.FIELDS}
+        self.count = 0
+        self.head = 0
+        self.ema = {}
+        self.latest = None
+        self.errors = 0
+        self._lock = threading.RLock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="battery-sampler", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def isRunning(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.add(self.source())
+            except Exception as err:
+                # A busy, glitching or short read only costs this sample, the thread must live on
+                self.errors += 1
+                print("ERR: Battery sample failed: %r" % err)
+            self._stop.wait(self.interval)
+
+    def add(self, sample):
+        """Store one BatterySample and update the moving averages."""
+        with self._lock:
+            self.times[self.head] = sample.timestamp
+            for field in self.FIELDS:
+                value = getattr(sample, field)
+                self.values[field][self.head] = value
+                if field in self.ema:
+                    self.ema[field] += self.alpha * (value - self.ema[field])
+                else:
+                    self.ema[field] = value
+            self.head = (self.head + 1) % self.size
+            self.count = min(self.count + 1, self.size)
+            self.latest = sample
+
+    def waitForSample(self, timeout=None):
+        """Block until the first sample is in, returns whether there is one."""
+        end = None if timeout is None else time.monotonic() + timeout
+        while self.count == 0:
+            if not self.isRunning() or (end is not None and time.monotonic() > end):
+                return False
+            time.sleep(0.01)
+        return True
+
+    def get(self, field, method="ema"):
+        """Return (filtered value, age in seconds), or (None, None) before the first sample.
+
+        :param field: One of FIELDS.
+        :param method: "ema", "median" (of the last MEDIAN_WINDOW samples) or "raw".
+
+        """
+        with self._lock:
+            if self.count == 0:
+                return None, None
+            age = time.time() - self.latest.timestamp
+            if method == "ema":
+                return self.ema[field], age
+            elif method == "raw":
+                return getattr(self.latest, field), age
+            elif method == "median":
+                return median(self.history(field, self.MEDIAN_WINDOW)[1]), age
+        raise ValueError("Unknown filter %s" % method)
+
+    def filtered(self):
+        """The newest BatterySample with its numeric fields replaced by their moving averages."""
+        with self._lock:
+            if self.count == 0:
+                return None
+            return self.latest._replace(**self.ema)
+
+    def history(self, field, limit=None):
+        """Return (times, values) arrays of the buffered samples, oldest first."""
+        with self._lock:
+            count = self.count if limit is None else min(limit, self.count)
+            start = (self.head - count) % self.size
+            if start + count <= self.size:
+                return self.times[start:start + count], self.values[field][start:start + count]
+            return self.times[start:] + self.times[:self.head], self.values[field][start:] + self.values[field][:self.head]
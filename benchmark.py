@@ -0,0 +1,409 @@
+import io
+import os
+import re
+import json
+import time
+import socket
+import shutil
+import argparse
+import platform
+import resource
+import tempfile
+import tracemalloc
+import threading
+import contextlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Import dependancies
+import numpy
+import PIL
+from PIL import Image, ImageDraw
+from inkyDisplay import InkySimClass
+from stageTimer import StageTimerClass
+import weather
+import diskCache
+import xkcdFetch
+import xkcdArchive
+import quantize
+import PiSugar
+import fakeSMBus
+import registerMonitor
+import WelcomeSign
+import goGophers
+import Logging
+
+# Get the current path
+PATH = os.path.dirname(__file__)
+
+# Canned inputs so every run renders exactly the same frames
+CANNED_TIME = 1700000000
+CANNED_BATTERY = 67.5
+CANNED_VOLTAGE = 3.912
+ONLINE_WEATHER = {
+    "current": True,
+    "temperature": 21.4,
+    "windspeed": 12.3,
+    "weathercode": 61,
+}
+OFFLINE_WEATHER = {
+    "current": False,
+    "temperature_max": 26.1,
+    "temperature_min": 14.8,
+    "apparent_temperature_max": 27.0,
+    "apparent_temperature_min": 13.2,
+    "weathercode": 3,
+}
+CANNED_DUMP = [(i * 37 + 11) % 256 for i in range(256)]
+
+
+def makeCannedComic(path, size=(740, 1100)):
+    """Draw a stand-in comic: black line art and lettering on white, taller than wide."""
+    comic = Image.new("L", size, 255)
+    draw = ImageDraw.Draw(comic)
+    panels = 3
+    panelHeight = size[1] // panels
+    for panel in range(panels):
+        top = panel * panelHeight
+        draw.rectangle((8, top + 8, size[0] - 8, top + panelHeight - 8), outline=0, width=3)
+        for line in range(6):
+            y = top + 30 + line * 18
+            draw.text((30, y), "THIS IS A LINE OF CANNED COMIC DIALOGUE %i" % line, fill=0)
+        draw.ellipse((size[0] // 2 - 40, top + 160, size[0] // 2 + 40, top + 240), outline=0, width=3)
+        draw.line((size[0] // 2, top + 240, size[0] // 2, top + panelHeight - 30), fill=0, width=3)
+    comic.save(path)
+
+
+def weatherScreen(weatherInfo):
+    def setup(display, timer):
+        manager = weather.WeatherManagerClass(display)
+        manager.timer = timer
+        return lambda: manager.renderWeather(weatherInfo, CANNED_BATTERY, CANNED_TIME)
+    return setup
+
+
+def xkcdScreen(display, timer):
+    comic = xkcdFetch.XkcdClass(display, refresh=False)
+    comic.TITLE = "Canned Comic"
+    comic.timer = timer
+    return comic.getFormattedImage
+
+
+def xkcdFrameScreen(display, timer):
+    # Only the first round renders, the others load the cached frame
+    comic = xkcdFetch.XkcdClass(display, refresh=False)
+    comic.TITLE = "Canned Comic"
+    comic.NUMBER = 2000
+    comic.timer = timer
+    return comic.getFrame
+
+
+def xkcdArchiveScreen(display, timer):
+    # Store the canned comic once, then time showing the stored frame
+    archive = xkcdArchive.XkcdArchiveClass(display, cache=diskCache.getCache(xkcdFetch.CACHE))
+    with Image.open(os.path.join(xkcdFetch.CACHE, "xkcd.png")) as comic:
+        archive.storeComic({"num": 2000, "title": "Canned Comic", "day": "1", "month": "1", "year": "2024"}, comic)
+
+    def render():
+        with timer.stage("asset load"):
+            return archive.getFrame(2000)
+    return render
+
+
+def welcomeScreen(display, timer):
+    return lambda: WelcomeSign.getWelcomeImage(display, timer)
+
+
+def gopherScreen(display, timer):
+    return lambda: goGophers.getGopherImage(display, timer)
+
+
+def batteryScreen(display, timer):
+    return lambda: Logging.renderBatteryScreen(display, CANNED_VOLTAGE, CANNED_BATTERY, CANNED_DUMP, timer)[0]
+
+
+SCREENS = {
+    "weather-online": weatherScreen(ONLINE_WEATHER),
+    "weather-offline": weatherScreen(OFFLINE_WEATHER),
+    "xkcd": xkcdScreen,
+    "xkcd-frame": xkcdFrameScreen,
+    "xkcd-archive": xkcdArchiveScreen,
+    "welcome": welcomeScreen,
+    "gophers": gopherScreen,
+    "battery": batteryScreen,
+}
+
+
+def benchScreen(setup, rounds):
+    display = InkySimClass(latency=0.0)
+    timer = StageTimerClass()
+    render = setup(display, timer)
+
+    times = []
+    tracemalloc.start()
+    # Renderers print warnings (e.g. offline weather), keep them out of the report
+    with contextlib.redirect_stdout(io.StringIO()):
+        for i in range(rounds):
+            start = time.perf_counter()
+            img = render()
+            with timer.stage("quantize"):
+                display.set_image(img)
+            times.append(time.perf_counter() - start)
+    _, peakTraced = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    # The first round is cold (icon atlas, font and file caches)
+    first = times[0]
+    times.sort()
+    return {
+        "rounds": rounds,
+        "first_ms": 1000 * first,
+        "min_ms": 1000 * times[0],
+        "median_ms": 1000 * times[len(times) // 2],
+        "max_ms": 1000 * times[-1],
+        "stages_ms": {name: 1000 * total / rounds for name, total in sorted(timer.stages.items())},
+        "peak_traced_kb": peakTraced / 1024,
+        "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+class _CountingWriter:
+    def __init__(self, wfile, counter):
+        self._wfile = wfile
+        self._counter = counter
+
+    def write(self, data):
+        self._counter[0] += len(data)
+        return self._wfile.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self._wfile, name)
+
+
+def xkcdStandInServer(comicPath):
+    """Serve info.0.json, /<num>/info.0.json and a comic on localhost, honouring If-None-Match.
+
+    Returns the running server and a one item list counting every byte
+    (headers included) written back to clients.
+    """
+    with open(comicPath, "rb") as comicFid:
+        comic = comicFid.read()
+    sent = [0]
+
+    class Handler(BaseHTTPRequestHandler):
+        def setup(self):
+            super().setup()
+            self.wfile = _CountingWriter(self.wfile, sent)
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            host = "http://%s:%i" % self.server.server_address[:2]
+            archived = re.fullmatch(r"/(\d+)/info\.0\.json", self.path)
+            if archived is not None and 0 < int(archived.group(1)) <= 2000:
+                # Older comics for the archive prefetcher, all the same picture
+                body = json.dumps({"num": int(archived.group(1)), "title": "Canned Comic %s" % archived.group(1), "img": host + "/comic.png", "day": "1", "month": "1", "year": "2024"}).encode()
+                etag = None
+                contentType = "application/json"
+            elif self.path == "/info.0.json":
+                body = json.dumps({"num": 2000, "title": "Canned Comic", "img": host + "/comic.png", "day": "1", "month": "1", "year": "2024"}).encode()
+                etag = '"canned-2000"'
+                if self.headers.get("If-None-Match") == etag:
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.end_headers()
+                    return
+                contentType = "application/json"
+            elif self.path == "/comic.png":
+                body = comic
+                etag = None
+                contentType = "image/png"
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", contentType)
+            self.send_header("Content-Length", str(len(body)))
+            if etag is not None:
+                self.send_header("ETag", etag)
+                self.send_header("Last-Modified", "Mon, 01 Jan 2024 00:00:00 GMT")
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, sent
+
+
+def benchXkcdFetch(rounds, cacheDir):
+    """Bytes on the wire per XKCD refresh: cold cache, then with and without validators."""
+    fetchDir = os.path.join(cacheDir, "fetch")
+    os.makedirs(fetchDir)
+    makeCannedComic(os.path.join(fetchDir, "comic.png"))
+    server, sent = xkcdStandInServer(os.path.join(fetchDir, "comic.png"))
+    xkcdFetch.CACHE = fetchDir
+
+    results = {}
+    try:
+        comic = xkcdFetch.XkcdClass(refresh=False)
+        comic.INFO_URL = "http://%s:%i/info.0.json" % server.server_address[:2]
+        with contextlib.redirect_stdout(io.StringIO()):
+            for name in ("cold", "conditional", "unconditional"):
+                sent[0] = 0
+                comic.bytesTransferred = 0
+                start = time.perf_counter()
+                for i in range(1 if name == "cold" else rounds):
+                    if name == "unconditional":
+                        # Same as before validators were stored: full info.0.json every time
+                        comic.cache.setMeta("info.0.json", {})
+                    comic.refresh()
+                elapsed = time.perf_counter() - start
+                count = 1 if name == "cold" else rounds
+                results[name] = {
+                    "wire_bytes_per_refresh": sent[0] / count,
+                    "body_bytes_per_refresh": comic.bytesTransferred / count,
+                    "ms_per_refresh": 1000 * elapsed / count,
+                }
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    for name, result in results.items():
+        print("xkcd-fetch %-13s %9.0f bytes  %7.2f ms per refresh" % (name, result["wire_bytes_per_refresh"], result["ms_per_refresh"]))
+    return results
+
+
+def makeCannedPhoto(size=(250, 122)):
+    """Smooth tones: a grey ramp across, fading into red towards the bottom."""
+    ramp = numpy.linspace(0, 255, size[0], dtype=numpy.float32)[None, :].repeat(size[1], axis=0)
+    fade = numpy.linspace(0, 1, size[1], dtype=numpy.float32)[:, None]
+    photo = numpy.stack([ramp + fade * (255 - ramp), ramp * (1 - fade), ramp * (1 - fade)], axis=2)
+    return Image.fromarray(photo.astype(numpy.uint8), "RGB")
+
+
+def benchQuantize(rounds, cacheDir):
+    """Time against quality for every quantize mode, on a comic frame and a photo."""
+    display = InkySimClass(latency=0.0)
+    with Image.open(os.path.join(cacheDir, "xkcd.png")) as comic:
+        sources = {"comic": xkcdFetch.formatComic(comic, "Canned Comic", display), "photo": makeCannedPhoto(display.resolution)}
+
+    results = {}
+    for sourceName, source in sources.items():
+        for mode in quantize.MODES:
+            times = []
+            for i in range(rounds):
+                start = time.perf_counter()
+                frame = quantize.palettize(source, display.colour, mode)
+                times.append(time.perf_counter() - start)
+            times.sort()
+            name = "%s/%s" % (sourceName, mode)
+            results[name] = {
+                "median_ms": 1000 * times[len(times) // 2],
+                "error": quantize.quantizeError(source, frame),
+                "colour_fraction": float((numpy.asarray(frame) == display.RED).mean()),
+            }
+            print("quantize %-24s %7.2f ms  error %5.1f  red %4.1f%%" % (name, results[name]["median_ms"], results[name]["error"], 100 * results[name]["colour_fraction"]))
+    return results
+
+
+def benchComicDecode(rounds, cacheDir):
+    """Full decode plus LANCZOS against loadComic's reduced decode, on large comics."""
+    box = (InkySimClass.WIDTH, InkySimClass.HEIGHT - xkcdFetch.HEADER)
+    large = os.path.join(cacheDir, "large.png")
+    makeCannedComic(large, (2220, 3300))
+    with Image.open(large) as comic:
+        comic.convert("RGB").save(os.path.join(cacheDir, "large.jpg"), quality=90)
+
+    def fullDecode(path):
+        img = Image.open(path)
+        img.load()
+        return img
+
+    results = {}
+    for source in ("large.png", "large.jpg"):
+        path = os.path.join(cacheDir, source)
+        for name, decode in (("full", fullDecode), ("reduced", lambda path: xkcdFetch.loadComic(path, box))):
+            times = []
+            for i in range(rounds):
+                start = time.perf_counter()
+                img = decode(path)
+                quotient = max(img.size[0] / box[0], img.size[1] / box[1])
+                img.resize((int(img.size[0] / quotient), int(img.size[1] / quotient)), Image.LANCZOS)
+                times.append(time.perf_counter() - start)
+            times.sort()
+            key = "%s/%s" % (source, name)
+            results[key] = {"median_ms": 1000 * times[len(times) // 2], "resampled_kb": img.size[0] * img.size[1] * len(img.getbands()) / 1024}
+            print("decode %-20s %8.2f ms  %7.0f KB resampled" % (key, results[key]["median_ms"], results[key]["resampled_kb"]))
+    return results
+
+
+def benchBatteryBus():
+    """Transactions and I2C time per PiSugar access pattern, on a replayed register dump."""
+    patterns = {
+        "snapshot": lambda sugar: sugar.snapshot(),
+        "snapshot-10": lambda sugar: sugar.snapshot(samples=10),
+        "sampler": lambda sugar: sugar.getSample(),
+        "buffDump": lambda sugar: sugar.buffDump(),
+        "monitor": lambda sugar: registerMonitor.RegisterMonitorClass(sugar).poll(),
+    }
+    results = {}
+    for name, access in patterns.items():
+        bus = fakeSMBus.ReplayBusClass([CANNED_DUMP])
+        sugar = PiSugar.PiSugarClass(bus)
+        if name == "sampler":
+            sugar.startSampler(interval=60.0).waitForSample(1.0)
+            sugar.stopSampler()
+            bus.transactions = 0
+            bus.busTime = 0.0
+        start = time.perf_counter()
+        access(sugar)
+        results[name] = {"transactions": bus.transactions, "bus_ms": 1000 * bus.busTime, "wall_ms": 1000 * (time.perf_counter() - start)}
+        print("pisugar %-12s %3i transactions  %6.2f ms on the bus  %7.1f ms wall" % (name, results[name]["transactions"], results[name]["bus_ms"], results[name]["wall_ms"]))
+    return results
+
+
+def runBenchmarks(screens, rounds, cacheDir):
+    # Point the scripts' caches at a scratch directory with canned content
+    weather.CACHE = cacheDir
+    xkcdFetch.CACHE = cacheDir
+    makeCannedComic(os.path.join(cacheDir, "xkcd.png"))
+
+    results = {}
+    for name in screens:
+        results[name] = benchScreen(SCREENS[name], rounds)
+        print("%-16s median %8.2f ms  (%s)" % (name, results[name]["median_ms"], ", ".join("%s %.2f" % item for item in results[name]["stages_ms"].items())))
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Render every screen with the simulated display and time each stage")
+    parser.add_argument("--rounds", type=int, default=20, help="Renders per screen")
+    parser.add_argument("--screen", action="append", choices=sorted(SCREENS), help="Only run this screen (repeatable)")
+    parser.add_argument("--output", default="benchmark.json", help="Where to save the JSON results")
+    args = parser.parse_args()
+
+    cacheDir = tempfile.mkdtemp(prefix="inky-bench-")
+    try:
+        results = runBenchmarks(args.screen or list(SCREENS), args.rounds, cacheDir)
+        quantizeResults = benchQuantize(args.rounds, cacheDir)
+        decodeResults = benchComicDecode(args.rounds, cacheDir)
+        batteryResults = benchBatteryBus()
+        fetchResults = benchXkcdFetch(args.rounds, cacheDir)
+    finally:
+        shutil.rmtree(cacheDir)
+
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "host": socket.gethostname(),
+        "machine": platform.machine(),
+        "python": platform.python_version(),
+        "pillow": PIL.__version__,
+        "screens": results,
+        "quantize": quantizeResults,
+        "comic_decode": decodeResults,
+        "pisugar_bus": batteryResults,
+        "xkcd_fetch": fetchResults,
+    }
+    with open(args.output, "w") as reportFid:
+        json.dump(report, reportFid, indent=2)
+    print("Results saved to %s" % args.output)
@@ -0,0 +1,61 @@
+import numpy
+
+
+def _runs(changed, gap):
+    """Return (start, stop) index pairs of True runs, merging runs closer than gap."""
+    index = numpy.flatnonzero(changed)
+    if index.size == 0:
+        return []
+    breaks = numpy.flatnonzero(numpy.diff(index) > gap + 1)
+    starts = numpy.concatenate(([index[0]], index[breaks + 1]))
+    stops = numpy.concatenate((index[breaks], [index[-1]])) + 1
+    return list(zip(starts.tolist(), stops.tolist()))
+
+
+def findDirtyRegions(previous, current, gap=4, align=1):
+    """Find the rectangles that differ between two frames.
+
+    Changed rows are grouped into horizontal bands (rows closer than gap
+    are merged) and each band is trimmed to the columns that changed in
+    it, which keeps separate widgets like the clock and the temperature
+    readout in separate rectangles.
+
+    :param previous: Last frame pushed to the display as a 2D (or HxWxC) array.
+    :param current: New frame in the same layout.
+    :param gap: Largest run of unchanged rows/columns merged into a region.
+    :param align: Round regions out to this many rows, e.g. 8 for byte wide RAM windows.
+
+    Returns a list of (x0, y0, x1, y1) tuples with exclusive x1/y1.
+    """
+    if previous is None or previous.shape != current.shape:
+        return [(0, 0, current.shape[1], current.shape[0])]
+
+    diff = previous != current
+    if diff.ndim == 3:
+        diff = diff.any(axis=2)
+
+    height = diff.shape[0]
+    bands = []
+    for y0, y1 in _runs(diff.any(axis=1), gap):
+        y0 = (y0 // align) * align
+        y1 = min(height, -(-y1 // align) * align)
+        if bands and y0 <= bands[-1][1]:
+            bands[-1] = (bands[-1][0], y1)
+        else:
+            bands.append((y0, y1))
+
+    regions = []
+    for y0, y1 in bands:
+        cols = _runs(diff[y0:y1].any(axis=0), gap)
+        regions.append((cols[0][0], y0, cols[-1][1], y1))
+    return regions
+
+
+def regionArea(regions):
+    return sum((x1 - x0) * (y1 - y0) for x0, y0, x1, y1 in regions)
+
+
+def boundingRegion(regions):
+    if not regions:
+        return None
+    return (min(r[0] for r in regions), min(r[1] for r in regions), max(r[2] for r in regions), max(r[3] for r in regions))
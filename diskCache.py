@@ -0,0 +1,270 @@
+import io
+import os
+import json
+import time
+import fcntl
+import atexit
+import tempfile
+import threading
+
+# Import secrets
+from secrets import Secrets
+
+# Get the current path
+CACHE = "/home/" + Secrets.username + "/.cache/Inky/"
+
+
+class DiskCacheClass:
+    """Size bounded cache directory shared by the fetchers.
+
+    Every entry is a file under the cache root plus a record in the index
+    (cacheIndex.json) holding its type, size, store/access times, optional
+    TTL, pin flag and free-form metadata (e.g. HTTP validators). Writes go
+    to a temp file that is fsync'ed and renamed into place, so readers never
+    see a half written entry. When the total size passes the byte budget,
+    the least recently used unpinned entries are evicted.
+
+    Files that already exist in the cache root but are not indexed yet
+    (e.g. from before this cache existed) are adopted on first access.
+    """
+
+    INDEX_NAME = "cacheIndex.json"
+    # SD cards are small and wear out, keep the whole cache modest
+    BUDGET = 32 * 1024 * 1024
+    CHUNK_SIZE = 16384
+
+    def __init__(self, root=CACHE, budget=BUDGET):
+        self.root = root
+        self.budget = budget
+        self.indexFile = os.path.join(root, self.INDEX_NAME)
+        self._lock = threading.RLock()
+        self.entries = {}
+        self._stats = {"hits": 0, "misses": 0, "stale": 0, "evictions": 0}
+        self._statDelta = dict.fromkeys(self._stats, 0)
+        self._dirty = set()
+        self._removed = set()
+        self._loadIndex()
+
+    def _readIndex(self):
+        try:
+            with open(self.indexFile, "r") as indexFid:
+                index = json.load(indexFid)
+            return index.get("entries", {}), index.get("stats", {})
+        except (OSError, ValueError):
+            return {}, {}
+
+    def _loadIndex(self):
+        entries, stats = self._readIndex()
+        self.entries = entries
+        self._stats.update(stats)
+
+    def _path(self, key):
+        path = os.path.normpath(os.path.join(self.root, key))
+        if key == self.INDEX_NAME or not path.startswith(os.path.normpath(self.root) + os.sep):
+            raise ValueError("Invalid cache key %s" % key)
+        return path
+
+    def _count(self, stat):
+        self._statDelta[stat] += 1
+
+    def _entry(self, key, kind):
+        entry = self.entries.get(key)
+        if entry is None:
+            path = self._path(key)
+            if os.path.isfile(path):
+                stat = os.stat(path)
+                entry = {"kind": kind, "size": stat.st_size, "stored": stat.st_mtime, "accessed": stat.st_mtime, "ttl": None, "pinned": False, "meta": {}}
+                self.entries[key] = entry
+                self._dirty.add(key)
+        return entry
+
+    def _lookup(self, key, kind, allowStale):
+        with self._lock:
+            entry = self._entry(key, kind)
+            if entry is None or not os.path.isfile(self._path(key)):
+                if entry is not None:
+                    self._forget(key)
+                self._count("misses")
+                return None
+            if not allowStale and not self._isFresh(entry):
+                self._count("stale")
+                return None
+            self._count("hits")
+            entry["accessed"] = time.time()
+            self._dirty.add(key)
+            return entry
+
+    @staticmethod
+    def _isFresh(entry):
+        return entry["ttl"] is None or time.time() - entry["stored"] < entry["ttl"]
+
+    def _forget(self, key):
+        self.entries.pop(key, None)
+        self._dirty.discard(key)
+        self._removed.add(key)
+
+    def isFresh(self, key):
+        entry = self.entries.get(key)
+        return entry is not None and self._isFresh(entry)
+
+    def age(self, key):
+        """Seconds since the entry was stored, or None if it isn't cached."""
+        entry = self._entry(key, "bytes")
+        return None if entry is None else time.time() - entry["stored"]
+
+    def getMeta(self, key):
+        entry = self._entry(key, "bytes")
+        return {} if entry is None else dict(entry["meta"])
+
+    def setMeta(self, key, meta):
+        with self._lock:
+            entry = self._entry(key, "bytes")
+            if entry is not None:
+                entry["meta"] = dict(meta)
+                self._dirty.add(key)
+                self.flush()
+
+    def getPath(self, key, allowStale=False):
+        """Return the file backing an entry (e.g. for Image.open), or None."""
+        entry = self._lookup(key, "file", allowStale)
+        return None if entry is None else self._path(key)
+
+    def getBytes(self, key, allowStale=False):
+        path = self.getPath(key, allowStale)
+        if path is None:
+            return None
+        with open(path, "rb") as entryFid:
+            return entryFid.read()
+
+    def getJson(self, key, allowStale=False):
+        data = self.getBytes(key, allowStale)
+        if data is None:
+            return None
+        try:
+            return json.loads(data.decode())
+        except ValueError:
+            print("ERR: Corrupt cache entry %s, dropping it" % key)
+            self.remove(key)
+            return None
+
+    def putStream(self, key, stream, ttl=None, meta=None, pinned=False, kind="file"):
+        """Stream into the cache atomically. Returns the number of bytes written.
+
+        If reading the stream fails, the previous entry is left untouched.
+        """
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        written = 0
+        tmpFid = tempfile.NamedTemporaryFile(dir=os.path.dirname(path), prefix=".cache-", delete=False)
+        try:
+            with tmpFid:
+                while True:
+                    chunk = stream.read(self.CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    tmpFid.write(chunk)
+                    written += len(chunk)
+                tmpFid.flush()
+                os.fsync(tmpFid.fileno())
+            os.replace(tmpFid.name, path)
+        except BaseException:
+            os.remove(tmpFid.name)
+            raise
+
+        now = time.time()
+        with self._lock:
+            self.entries[key] = {"kind": kind, "size": written, "stored": now, "accessed": now, "ttl": ttl, "pinned": pinned, "meta": dict(meta or {})}
+            self._dirty.add(key)
+            self._removed.discard(key)
+            self.evict()
+            self.flush()
+        return written
+
+    def putBytes(self, key, data, ttl=None, meta=None, pinned=False, kind="bytes"):
+        return self.putStream(key, io.BytesIO(data), ttl, meta, pinned, kind)
+
+    def putJson(self, key, value, ttl=None, meta=None, pinned=False):
+        return self.putBytes(key, json.dumps(value).encode(), ttl, meta, pinned, kind="json")
+
+    def remove(self, key):
+        with self._lock:
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+            self._forget(key)
+
+    def totalSize(self):
+        return sum(entry["size"] for entry in self.entries.values())
+
+    def evict(self, budget=None, prefix=""):
+        """Drop least recently used unpinned entries until under budget.
+
+        :param budget: Byte budget, defaults to the whole cache's budget.
+        :param prefix: Only count and evict keys starting with this prefix.
+
+        """
+        if budget is None:
+            budget = self.budget
+        with self._lock:
+            keys = [key for key in self.entries if key.startswith(prefix)]
+            total = sum(self.entries[key]["size"] for key in keys)
+            if total <= budget:
+                return []
+            evicted = []
+            for key in sorted(keys, key=lambda key: self.entries[key]["accessed"]):
+                if total <= budget:
+                    break
+                if self.entries[key]["pinned"]:
+                    continue
+                total -= self.entries[key]["size"]
+                self.remove(key)
+                self._count("evictions")
+                evicted.append(key)
+            return evicted
+
+    def getStats(self):
+        stats = {name: self._stats[name] + self._statDelta[name] for name in self._stats}
+        stats["entries"] = len(self.entries)
+        stats["bytes"] = self.totalSize()
+        return stats
+
+    def flush(self):
+        """Merge this process' changes into the index on disk."""
+        with self._lock:
+            if not self._dirty and not self._removed and not any(self._statDelta.values()):
+                return
+            os.makedirs(self.root, exist_ok=True)
+            with open(self.indexFile + ".lock", "w") as lockFid:
+                # Other scripts may have written the index since we read it
+                fcntl.flock(lockFid, fcntl.LOCK_EX)
+                entries, stats = self._readIndex()
+                for key in self._removed:
+                    entries.pop(key, None)
+                for key in self._dirty:
+                    if key in self.entries:
+                        entries[key] = self.entries[key]
+                for name, delta in self._statDelta.items():
+                    stats[name] = stats.get(name, 0) + delta
+
+                with open(self.indexFile + ".tmp", "w") as indexFid:
+                    json.dump({"entries": entries, "stats": stats}, indexFid)
+                os.replace(self.indexFile + ".tmp", self.indexFile)
+
+            self.entries = entries
+            self._stats = {name: stats.get(name, 0) for name in self._stats}
+            self._statDelta = dict.fromkeys(self._stats, 0)
+            self._dirty = set()
+            self._removed = set()
+
+
+_caches = {}
+
+
+def getCache(root=CACHE):
+    """Return the shared cache for a directory, flushed when the process exits."""
+    root = os.path.normpath(root)
+    if root not in _caches:
+        _caches[root] = DiskCacheClass(root)
+        atexit.register(_caches[root].flush)
+    return _caches[root]
@@ -0,0 +1,182 @@
+import re
+import json
+import time
+
+from batteryLog import RegisterLogClass
+
+# 7 bit address the PiSugar 3 answers on
+PISUGAR_ADDRESS = 0x57
+
+
+class ReplayBusClass:
+    """SMBus stand-in that answers from recorded PiSugar register dumps.
+
+    Each frame is a 256 byte register image, e.g. one PiSugarClass.buffDump
+    or one line of the Logging.py --display CSV. Reads are served from the
+    current frame, and the replay moves on to the next frame every
+    transactionsPerFrame transactions (or on advance()), looping at the end.
+    Writes change the current frame only.
+
+    Every transaction is charged the time it would take on a real bus:
+    a fixed driver overhead plus 9 bit times for every byte on the wire.
+    That time is added up in busTime, and also slept when realtime is set,
+    so access patterns can be compared without the hardware.
+    """
+
+    # Address, register, repeated start address, then the data bytes
+    FRAMING_BYTES = 3
+    # ioctl round trip on a Pi Zero, in seconds
+    OVERHEAD = 0.0002
+
+    def __init__(self, frames, address=PISUGAR_ADDRESS, busHz=100000, transactionsPerFrame=None, realtime=False):
+        if not frames:
+            raise ValueError("Nothing to replay")
+        self.frames = [list(frame) + [0] * (256 - len(frame)) for frame in frames]
+        self.address = address
+        self.busHz = busHz
+        self.transactionsPerFrame = transactionsPerFrame
+        self.realtime = realtime
+        self.index = 0
+        self.transactions = 0
+        self.bytesTransferred = 0
+        self.busTime = 0.0
+        self._sinceAdvance = 0
+
+    @classmethod
+    def fromFile(cls, path, **kwargs):
+        """Replay a register log (batteryLog.RegisterLogClass), a dump CSV (see
+        loadDumps) or a RecordingBusClass JSON lines file."""
+        with open(path, "rb") as dumpFid:
+            magic = dumpFid.read(len(RegisterLogClass.MAGIC))
+        if magic in (RegisterLogClass.MAGIC, RegisterLogClass.LEGACY_MAGIC):
+            return cls(RegisterLogClass(path).mapFile(path)["dump"].tolist(), **kwargs)
+        with open(path, "r") as dumpFid:
+            text = dumpFid.read()
+        if text.lstrip().startswith("{"):
+            return cls(loadRecording(text), **kwargs)
+        return cls(loadDumps(text), **kwargs)
+
+    def _transaction(self, address, dataBytes):
+        if address != self.address:
+            raise OSError(121, "Remote I/O error")
+        duration = self.OVERHEAD + 9 * (self.FRAMING_BYTES + dataBytes) / self.busHz
+        self.transactions += 1
+        self.bytesTransferred += dataBytes
+        self.busTime += duration
+        if self.realtime:
+            time.sleep(duration)
+
+        frame = self.frames[self.index]
+        self._sinceAdvance += 1
+        if self.transactionsPerFrame is not None and self._sinceAdvance >= self.transactionsPerFrame:
+            self.advance()
+        return frame
+
+    def advance(self):
+        self.index = (self.index + 1) % len(self.frames)
+        self._sinceAdvance = 0
+
+    def read_byte_data(self, address, register):
+        return self._transaction(address, 1)[register]
+
+    def read_i2c_block_data(self, address, register, length=32):
+        length = min(length, 32)
+        frame = self._transaction(address, length)
+        return frame[register:register + length] + [0] * max(0, register + length - 256)
+
+    def write_byte_data(self, address, register, value):
+        self._transaction(address, 1)[register] = value & 0xFF
+
+    def close(self):
+        pass
+
+
+class RecordingBusClass:
+    """Wraps a real SMBus and logs every transaction as a JSON line.
+
+    The log can be replayed with ReplayBusClass.fromFile.
+    """
+
+    def __init__(self, bus, path):
+        self.bus = bus
+        self.fid = open(path, "a")
+
+    def _record(self, op, address, register, data):
+        self.fid.write(json.dumps({"t": time.time(), "op": op, "address": address, "register": register, "data": data}) + "\n")
+        self.fid.flush()
+
+    def read_byte_data(self, address, register):
+        value = self.bus.read_byte_data(address, register)
+        self._record("read", address, register, [value])
+        return value
+
+    def read_i2c_block_data(self, address, register, length=32):
+        data = self.bus.read_i2c_block_data(address, register, length)
+        self._record("read", address, register, list(data))
+        return data
+
+    def write_byte_data(self, address, register, value):
+        self.bus.write_byte_data(address, register, value)
+        self._record("write", address, register, [value])
+
+    def close(self):
+        self.fid.close()
+        self.bus.close()
+
+
+def loadStampedDumps(text):
+    """Parse register dumps into (stamp, frame) pairs.
+
+    Each dump is a time stamp (HH:MM, optionally preceded by a MM/DD/YYYY
+    date) followed by 256 hex bytes. The stamp is returned as written, any
+    other tokens (e.g. the voltage of a register log export) are skipped.
+    Registers a register log export marks as unread ("--") come back as None.
+    """
+    dumps = []
+    date = None
+    for token in re.split(r"[,\s]+", text):
+        if re.fullmatch(r"\d{1,2}/\d{1,2}/\d{4}", token):
+            date = token
+        elif re.fullmatch(r"\d{1,2}:\d{2}", token):
+            dumps.append([token if date is None else "%s %s" % (date, token), []])
+            date = None
+        elif re.fullmatch(r"0[xX][0-9a-fA-F]{1,2}", token):
+            if not dumps:
+                dumps.append([None, []])
+            dumps[-1][1].append(int(token, 16))
+        elif token == "--" and dumps:
+            dumps[-1][1].append(None)
+    return [(stamp, frame) for stamp, frame in dumps if frame]
+
+
+def loadDumps(text):
+    """Parse register dumps: a time stamp (HH:MM) followed by 256 hex bytes each.
+
+    Understands the Logging.py --display CSV, which used to be written
+    without newlines, as well as one dump per line.
+    """
+    return [[byte or 0 for byte in frame] for stamp, frame in loadStampedDumps(text)]
+
+
+def loadRecording(text, base=None):
+    """Turn a RecordingBusClass log into register frames.
+
+    Reads are applied to a running register image. A new frame starts
+    whenever a register that was already read in the current frame is
+    read again, i.e. once per polling cycle.
+    """
+    image = list(base) if base is not None else [0] * 256
+    frames = []
+    seen = set()
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        span = set(range(record["register"], record["register"] + len(record["data"])))
+        if record["op"] == "read" and span & seen:
+            frames.append(list(image))
+            seen = set()
+        image[record["register"]:record["register"] + len(record["data"])] = record["data"]
+        seen |= span
+    frames.append(image)
+    return frames
@@ -0,0 +1,109 @@
+import os
+import json
+import time
+import threading
+
+
+class FetchStageClass:
+    """Runs independent data sources side by side under one deadline.
+
+    Each source runs in its own daemon thread, so the cycle costs about as
+    long as the slowest source instead of the sum of them all. Sources that
+    raise, or are still running when the deadline passes, are replaced by
+    their fallback. Without an explicit fallback, the last good value of
+    that source (kept in fetchStage.json in the cache directory) is used.
+
+    Usage::
+
+        stage = FetchStageClass(CACHE, deadline=8.0)
+        stage.add("battery", PiSugar.getBatteryPerc)
+        results = stage.gather()
+    """
+
+    STATE_NAME = "fetchStage.json"
+    _MISSING = object()
+
+    def __init__(self, cacheDir, deadline=8.0):
+        self.stateFile = os.path.join(cacheDir, self.STATE_NAME)
+        self.deadline = deadline
+        self._sources = []
+        self.timedOut = []
+        self.failed = []
+        self.durations = {}
+
+    def add(self, name, fetch, fallback=_MISSING):
+        """Register a source.
+
+        :param name: Key of the result in the dictionary returned by gather.
+        :param fetch: Callable taking no arguments.
+        :param fallback: Callable used when fetch fails or is late. Defaults
+            to the source's last cached value (or None).
+
+        """
+        self._sources.append((name, fetch, fallback))
+
+    def _loadState(self):
+        try:
+            with open(self.stateFile, "r") as stateFid:
+                return json.load(stateFid)
+        except (OSError, ValueError):
+            return {}
+
+    def _saveState(self, state):
+        try:
+            os.makedirs(os.path.dirname(self.stateFile), exist_ok=True)
+            with open(self.stateFile + ".tmp", "w") as stateFid:
+                json.dump(state, stateFid)
+            os.replace(self.stateFile + ".tmp", self.stateFile)
+        except (OSError, TypeError) as err:
+            print("ERR: Could not save fetch results: %s" % err)
+
+    def gather(self):
+        """Run every source and return a dictionary of their results."""
+        results = {}
+        errors = {}
+        started = {}
+
+        def run(name, fetch):
+            started[name] = time.monotonic()
+            try:
+                results[name] = fetch()
+            except Exception as err:
+                errors[name] = err
+            self.durations[name] = time.monotonic() - started[name]
+
+        threads = []
+        for name, fetch, fallback in self._sources:
+            thread = threading.Thread(target=run, args=(name, fetch), name="fetch-%s" % name, daemon=True)
+            thread.start()
+            threads.append((name, thread))
+
+        end = time.monotonic() + self.deadline
+        for name, thread in threads:
+            thread.join(max(0.0, end - time.monotonic()))
+
+        state = self._loadState()
+        gathered = {}
+        self.timedOut = []
+        self.failed = []
+        for name, fetch, fallback in self._sources:
+            if name in results:
+                gathered[name] = results[name]
+                if fallback is self._MISSING:
+                    state[name] = results[name]
+                continue
+
+            if name in errors:
+                self.failed.append(name)
+                print("ERR: %s failed (%s), using fallback" % (name, errors[name]))
+            else:
+                self.timedOut.append(name)
+                print("ERR: %s missed the %.1f s deadline, using fallback" % (name, self.deadline))
+
+            if fallback is self._MISSING:
+                gathered[name] = state.get(name)
+            else:
+                gathered[name] = fallback()
+
+        self._saveState(state)
+        return gathered
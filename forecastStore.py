@@ -0,0 +1,123 @@
+import time
+import struct
+from array import array
+from bisect import bisect_left, bisect_right
+
+
+class ForecastStoreClass:
+    """Hourly forecast series kept in compact typed arrays.
+
+    Samples are sorted by time, so "what is it like now" is a binary
+    search plus a linear interpolation between the two surrounding hours,
+    however many days of forecast are stored. The store is saved as a
+    small binary entry of the disk cache: a header followed by the raw
+    arrays.
+    """
+
+    FILE_NAME = "forecast.bin"
+    MAGIC = b"IFC1"
+    HEADER = struct.Struct("<4sI")
+
+    # Drop samples older than this, and never keep more than MAX_SAMPLES
+    KEEP_PAST = 86400
+    MAX_SAMPLES = 24 * 16
+    # How far past the last sample an answer is still given, in seconds
+    STEP = 3600
+
+    def __init__(self, cache):
+        self.cache = cache
+        self.times = array("d")
+        self.temperature = array("f")
+        self.apparent = array("f")
+        self.codes = array("B")
+        self.load()
+
+    def __len__(self):
+        return len(self.times)
+
+    def load(self):
+        data = self.cache.getBytes(self.FILE_NAME, allowStale=True)
+        if data is None:
+            return False
+        try:
+            magic, count = self.HEADER.unpack_from(data)
+            if magic != self.MAGIC:
+                raise ValueError("Not a forecast store")
+            offset = self.HEADER.size
+            arrays = []
+            for typecode in ("d", "f", "f", "B"):
+                column = array(typecode)
+                end = offset + count * column.itemsize
+                column.frombytes(data[offset:end])
+                if len(column) != count:
+                    raise ValueError("Truncated forecast store")
+                arrays.append(column)
+                offset = end
+        except (ValueError, struct.error):
+            print("ERR: Could not read the forecast store")
+            return False
+        self.times, self.temperature, self.apparent, self.codes = arrays
+        return True
+
+    def save(self):
+        data = self.HEADER.pack(self.MAGIC, len(self.times))
+        data += self.times.tobytes() + self.temperature.tobytes() + self.apparent.tobytes() + self.codes.tobytes()
+        self.cache.putBytes(self.FILE_NAME, data, pinned=True)
+
+    def merge(self, hourly, now=None):
+        """Merge an Open Meteo "hourly" block (unixtime format) into the store.
+
+        Newer samples replace stored ones from the same time onwards.
+        """
+        times = hourly["time"]
+        if not times:
+            return
+        if now is None:
+            now = time.time()
+
+        # Keep what we had before the new series starts, then append it
+        keep = bisect_left(self.times, times[0])
+        start = min(bisect_left(self.times, now - self.KEEP_PAST), keep)
+        self.times = self.times[start:keep]
+        self.temperature = self.temperature[start:keep]
+        self.apparent = self.apparent[start:keep]
+        self.codes = self.codes[start:keep]
+
+        temperature = hourly["temperature_2m"]
+        apparent = hourly.get("apparent_temperature", temperature)
+        codes = hourly["weather_code"]
+        for i in range(len(times)):
+            if temperature[i] is None or codes[i] is None:
+                continue
+            self.times.append(times[i])
+            self.temperature.append(temperature[i])
+            self.apparent.append(apparent[i] if apparent[i] is not None else temperature[i])
+            self.codes.append(codes[i])
+
+        if len(self.times) > self.MAX_SAMPLES:
+            cut = len(self.times) - self.MAX_SAMPLES
+            self.times = self.times[cut:]
+            self.temperature = self.temperature[cut:]
+            self.apparent = self.apparent[cut:]
+            self.codes = self.codes[cut:]
+
+    def lookup(self, when=None):
+        """Return (temperature, apparent temperature, weather code) at a time.
+
+        Temperatures are interpolated between the surrounding hours, the
+        weather code is the one of the hour containing the time. Returns
+        None when the time is outside the stored series.
+        """
+        if when is None:
+            when = time.time()
+        i = bisect_right(self.times, when)
+        if i == 0 or when > self.times[-1] + self.STEP:
+            return None
+
+        if i == len(self.times):
+            return (self.temperature[-1], self.apparent[-1], self.codes[-1])
+        t0, t1 = self.times[i - 1], self.times[i]
+        fraction = (when - t0) / (t1 - t0)
+        temperature = self.temperature[i - 1] + fraction * (self.temperature[i] - self.temperature[i - 1])
+        apparent = self.apparent[i - 1] + fraction * (self.apparent[i] - self.apparent[i - 1])
+        return (temperature, apparent, self.codes[i - 1])
@@ -0,0 +1,184 @@
+import os
+import json
+import hashlib
+
+# Import dependancies
+import numpy
+from dirtyRegion import findDirtyRegions, regionArea
+
+
+class FrameGuardClass:
+    """Wraps an Inky display and skips refreshes that would not change it.
+
+    The guard hashes the palettized frame (and border colour) that the
+    driver is about to push and compares it with the last frame that was
+    actually shown. The hash and that frame live in the cache directory so
+    the check also works across the separate cron driven scripts sharing
+    one panel. A simulated display keeps its own state files, so its
+    frames never suppress a refresh of the real panel. Everything else is
+    passed straight through to the wrapped display.
+
+    When the frame did change, the guard records which rectangles moved.
+    Drivers offering a ``show_partial(regions)`` method get a windowed
+    update for small changes; the SSD1608 driver does not, so there the
+    dirty area is only reported (see ``suggestRefresh``).
+    """
+
+    STATE_NAME = "frameGuard.json"
+    FRAME_NAME = "frameGuard.npy"
+
+    # Largest share of the panel that may be updated with a partial refresh
+    PARTIAL_LIMIT = 0.25
+    # Force a full refresh after this many partials to clear ghosting
+    MAX_PARTIALS = 5
+
+    def __init__(self, display, cacheDir):
+        self._display = display
+        self._image = None
+        prefix = "sim-" if getattr(display, "SIMULATED", False) else ""
+        self.stateFile = os.path.join(cacheDir, prefix + self.STATE_NAME)
+        self.frameFile = os.path.join(cacheDir, prefix + self.FRAME_NAME)
+        self.lastDigest = None
+        self.lastFrame = None
+        self.refreshesSkipped = 0
+        self.refreshesPerformed = 0
+        self.partialRefreshes = 0
+        self.partialsSinceFull = 0
+        self.dirtyRegions = []
+        self._loadState()
+
+    def __getattr__(self, name):
+        # Only called for attributes not found on the guard itself
+        return getattr(self._display, name)
+
+    def _loadState(self):
+        try:
+            with open(self.stateFile, "r") as stateFid:
+                state = json.load(stateFid)
+            if state["digest"] != self.lastDigest:
+                # Another script has drawn since, its frame replaces ours
+                self.lastFrame = None
+            self.lastDigest = state["digest"]
+            self.refreshesSkipped = state["skipped"]
+            self.refreshesPerformed = state["performed"]
+            self.partialRefreshes = state.get("partial", 0)
+            self.partialsSinceFull = state.get("partialsSinceFull", 0)
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def _saveState(self):
+        os.makedirs(os.path.dirname(self.stateFile), exist_ok=True)
+        tmpFile = self.stateFile + ".tmp"
+        with open(tmpFile, "w") as stateFid:
+            json.dump({
+                "digest": self.lastDigest,
+                "skipped": self.refreshesSkipped,
+                "performed": self.refreshesPerformed,
+                "partial": self.partialRefreshes,
+                "partialsSinceFull": self.partialsSinceFull,
+            }, stateFid)
+        os.replace(tmpFile, self.stateFile)
+
+    def _saveFrame(self, frame):
+        tmpFile = self.frameFile + ".tmp"
+        with open(tmpFile, "wb") as frameFid:
+            numpy.save(frameFid, frame)
+        os.replace(tmpFile, self.frameFile)
+        self.lastFrame = frame
+
+    def _loadFrame(self):
+        if self.lastFrame is None:
+            try:
+                self.lastFrame = numpy.load(self.frameFile)
+            except (OSError, ValueError):
+                pass
+        return self.lastFrame
+
+    def frameArray(self):
+        """Return the frame currently loaded into the display as an array."""
+        # The SSD1608 driver keeps the palettized frame in a numpy buffer
+        buf = getattr(self._display, "buf", None)
+        if buf is not None:
+            return numpy.asarray(buf)
+        if self._image is None:
+            return numpy.zeros((0, 0), dtype=numpy.uint8)
+        return numpy.asarray(self._image)
+
+    def frameDigest(self, frame=None):
+        """Return the hash of the frame currently loaded into the display."""
+        if frame is None:
+            frame = self.frameArray()
+        border = getattr(self._display, "border_colour", None)
+        digest = hashlib.sha1(("%r %s %s" % (border, frame.shape, frame.dtype)).encode())
+        digest.update(numpy.ascontiguousarray(frame).tobytes())
+        return digest.hexdigest()
+
+    def findDirtyRegions(self, frame=None):
+        """Return the rectangles that differ from the last frame shown."""
+        if frame is None:
+            frame = self.frameArray()
+        return findDirtyRegions(self._loadFrame(), frame, align=8)
+
+    def dirtyFraction(self, regions, frame=None):
+        if frame is None:
+            frame = self.frameArray()
+        pixels = frame.shape[0] * frame.shape[1]
+        return regionArea(regions) / pixels if pixels else 1.0
+
+    def supportsPartial(self):
+        return callable(getattr(self._display, "show_partial", None))
+
+    def suggestRefresh(self):
+        """Suggest "none", "partial" or "full" for the frame currently loaded.
+
+        "partial" means the change is small enough for a cheap refresh; the
+        scheduler may defer it (or use show_partial where available).
+        """
+        frame = self.frameArray()
+        if self.frameDigest(frame) == self.lastDigest:
+            return "none"
+        return self._refreshKind(frame, self.findDirtyRegions(frame))
+
+    def _refreshKind(self, frame, regions):
+        if self.partialsSinceFull < self.MAX_PARTIALS and self.dirtyFraction(regions, frame) <= self.PARTIAL_LIMIT:
+            return "partial"
+        return "full"
+
+    def set_image(self, image):
+        self._image = image
+        self._display.set_image(image)
+
+    def show(self, force=False, **kwargs):
+        """Refresh the display unless the frame is identical to the one showing.
+
+        :param force: Do a full refresh even if the frame has not changed.
+
+        """
+        # Other scripts may have drawn on the panel since this guard last looked
+        self._loadState()
+        frame = self.frameArray()
+        digest = self.frameDigest(frame)
+        if not force and digest == self.lastDigest:
+            self.dirtyRegions = []
+            self.refreshesSkipped += 1
+            self._saveState()
+            print("Info: Frame unchanged, skipping refresh")
+            return False
+
+        self.dirtyRegions = self.findDirtyRegions(frame)
+        if not force and self.supportsPartial() and self._refreshKind(frame, self.dirtyRegions) == "partial":
+            self._display.show_partial(self.dirtyRegions, **kwargs)
+            self.partialRefreshes += 1
+            self.partialsSinceFull += 1
+        else:
+            self._display.show(**kwargs)
+            self.partialsSinceFull = 0
+
+        self.lastDigest = digest
+        self.refreshesPerformed += 1
+        self._saveState()
+        self._saveFrame(frame.copy())
+        return True
+
+    def getCounters(self):
+        return {"skipped": self.refreshesSkipped, "performed": self.refreshesPerformed, "partial": self.partialRefreshes}
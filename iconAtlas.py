@@ -0,0 +1,135 @@
+import os
+import pickle
+import hashlib
+
+# Import dependancies
+from PIL import Image
+from inkyMask import create_mask, INKY_COLOURS
+
+# Get the current path
+PATH = os.path.dirname(__file__)
+
+
+class IconAtlasClass:
+    """Icons and their transparency masks, baked once and cached on disk.
+
+    Each entry is keyed by its path relative to this repository and
+    remembers the source file's mtime, size and SHA1 so a stale entry is
+    rebuilt while a freshly checked out (but unchanged) file is not.
+    Icons are only opened, stat'ed or decoded when they are requested.
+    """
+
+    CACHE_NAME = "iconAtlas.pickle"
+    VERSION = 1
+
+    # This maps the weather code from Open Meteo
+    # to the appropriate weather icons
+    # Weather codes from https://open-meteo.com/en/docs
+    ICON_MAP = {
+        "snow": [71, 73, 75, 77, 85, 86],
+        "rain": [51, 53, 55, 56, 57, 61, 63, 65, 66, 67, 80, 81, 82],
+        "cloud": [1, 2, 3, 45, 48],
+        "sun": [0],
+        "storm": [95, 96, 99],
+        "wind": []
+    }
+    WEATHER_ICON = "resources/icons/weather/icon-%s.png"
+
+    def __init__(self, cacheDir, allowed=INKY_COLOURS):
+        self.cacheFile = os.path.join(cacheDir, self.CACHE_NAME)
+        self.allowed = tuple(allowed)
+        self._entries = None
+        self._icons = {}
+        self._dirty = False
+
+        self._codeMap = {}
+        for name, codes in self.ICON_MAP.items():
+            for code in codes:
+                self._codeMap[code] = name
+
+    def _loadEntries(self):
+        if self._entries is not None:
+            return
+        self._entries = {}
+        try:
+            with open(self.cacheFile, "rb") as atlasFid:
+                cached = pickle.load(atlasFid)
+            if cached.get("version") == self.VERSION and cached.get("allowed") == self.allowed:
+                self._entries = cached["icons"]
+        except (OSError, EOFError, pickle.UnpicklingError, KeyError, AttributeError):
+            print("ERR: Could not open icon atlas, rebuilding")
+
+    def _bake(self, fullPath, stat):
+        source = Image.open(fullPath)
+        source.load()
+        if source.mode not in ("P", "L"):
+            source = source.convert("P")
+        mask = create_mask(source, self.allowed)
+        return {
+            "mtime": stat.st_mtime_ns,
+            "size": stat.st_size,
+            "sha1": self._hashFile(fullPath),
+            "mode": source.mode,
+            "dims": source.size,
+            "palette": bytes(source.getpalette() or []),
+            "pixels": source.tobytes(),
+            "mask": mask.tobytes(),
+        }
+
+    def _isCurrent(self, entry, fullPath, stat):
+        if entry["mtime"] == stat.st_mtime_ns and entry["size"] == stat.st_size:
+            return True
+
+        # Timestamp moved (e.g. a fresh checkout), only rebake if the content did too
+        if self._hashFile(fullPath) == entry["sha1"]:
+            entry["mtime"] = stat.st_mtime_ns
+            self._dirty = True
+            return True
+        return False
+
+    @staticmethod
+    def _hashFile(fullPath):
+        with open(fullPath, "rb") as iconFid:
+            return hashlib.sha1(iconFid.read()).hexdigest()
+
+    def getIcon(self, relPath):
+        """Return an (icon, mask) pair for a path relative to this repository."""
+        if relPath in self._icons:
+            return self._icons[relPath]
+
+        self._loadEntries()
+        fullPath = os.path.join(PATH, relPath)
+        stat = os.stat(fullPath)
+        entry = self._entries.get(relPath)
+        if entry is None or not self._isCurrent(entry, fullPath, stat):
+            entry = self._bake(fullPath, stat)
+            self._entries[relPath] = entry
+            self._dirty = True
+
+        icon = Image.frombytes(entry["mode"], entry["dims"], entry["pixels"])
+        if entry["palette"]:
+            icon.putpalette(entry["palette"])
+        mask = Image.frombytes("1", entry["dims"], entry["mask"])
+        self._icons[relPath] = (icon, mask)
+        return icon, mask
+
+    def getWeatherIconName(self, weathercode):
+        return self._codeMap.get(weathercode)
+
+    def getWeatherIcon(self, weathercode):
+        """Return the (icon, mask) pair for an Open Meteo weather code, or None."""
+        name = self.getWeatherIconName(weathercode)
+        if name is None:
+            return None
+        return self.getIcon(self.WEATHER_ICON % name)
+
+    def save(self):
+        """Write any newly baked icons back to the cache directory."""
+        if not self._dirty:
+            return
+        os.makedirs(os.path.dirname(self.cacheFile), exist_ok=True)
+        tmpFile = self.cacheFile + ".tmp"
+        with open(tmpFile, "wb") as atlasFid:
+            pickle.dump({"version": self.VERSION, "allowed": self.allowed, "icons": self._entries}, atlasFid, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmpFile, self.cacheFile)
+        self._dirty = False
@@ -0,0 +1,145 @@
+import os
+import time
+
+# Import dependancies
+import numpy
+from PIL import Image
+from quantize import panelPalette, palettize
+
+try:
+    from inky import eeprom
+    from inky import phat
+except ImportError as err:
+    eeprom = None
+    phat = None
+    # Kept for InkyConnect(simulate=False), which must not fall back silently
+    _inkyImportError = err
+
+# Debug boolean
+DEBUG = True
+
+# Names the board, present on every Raspberry Pi
+MODEL_FILE = "/proc/device-tree/model"
+
+
+def onRaspberryPi():
+    try:
+        with open(MODEL_FILE, "r") as modelFid:
+            return "Raspberry Pi" in modelFid.read()
+    except OSError:
+        return False
+
+
+def InkyConnect(colour="red", simulate=None, outputDir=None):
+    """Connect to the Inky pHAT, or to a simulated one.
+
+    The simulator is used when asked for (or when INKY_SIMULATE is set in
+    the environment), and when simulate is left as None and the inky
+    library is not installed on a machine that isn't a Raspberry Pi, so
+    the scripts can be run and timed on a plain Linux box. On a Pi a
+    broken inky install raises its ImportError instead.
+
+    :param colour: Display colour variant, as passed to the inky driver.
+    :param simulate: Force (True) or forbid (False) the simulator, a
+        forbidden simulator raises the inky ImportError instead.
+    :param outputDir: Where the simulator writes its frames (INKY_SIM_DIR).
+
+    """
+    if outputDir is None:
+        outputDir = os.environ.get("INKY_SIM_DIR")
+    if simulate is False and phat is None:
+        raise _inkyImportError
+    if simulate is None:
+        simulate = bool(os.environ.get("INKY_SIMULATE"))
+        if not simulate and phat is None:
+            if onRaspberryPi():
+                raise _inkyImportError
+            print("Attention, no inky library found! Using the simulated display")
+            simulate = True
+    if simulate:
+        return InkySimClass(colour, outputDir=outputDir)
+
+    # Connect to the Inky Display
+    _eeprom = eeprom.read_eeprom()
+    if _eeprom is None:
+        raise RuntimeError("No EEPROM detected! You must manually initialise your Inky board.")
+    elif _eeprom.display_variant != 11:
+        if DEBUG:
+            print("Found eeprom id %s" % _eeprom.display_variant)
+        raise RuntimeError("Display is not the expected variant")
+
+    return phat.InkyPHAT_SSD1608(colour)
+
+
+class InkySimClass:
+    """Headless stand-in for inky.phat.InkyPHAT_SSD1608.
+
+    Offers the same surface the scripts use (resolution, colour constants,
+    set_border, set_image, show) and palettizes frames the same way the
+    driver does. Shown frames are kept as raw buffers, optionally written
+    out as PNGs, and the panel's refresh time is either slept for
+    (realtime) or just added up in simulatedTime.
+    """
+
+    # Lets FrameGuardClass keep simulated frames apart from the real panel's
+    SIMULATED = True
+
+    WIDTH = 250
+    HEIGHT = 122
+
+    WHITE = 0
+    BLACK = 1
+    RED = 2
+    YELLOW = 2
+
+    # Rough full refresh time of the three colour SSD1608 panel in seconds
+    REFRESH_LATENCY = 15.0
+
+    def __init__(self, colour="red", outputDir=None, latency=REFRESH_LATENCY, realtime=False, keepFrames=False):
+        self.colour = colour
+        self.resolution = (self.WIDTH, self.HEIGHT)
+        self.width, self.height = self.resolution
+        self.border_colour = self.WHITE
+        self.buf = numpy.zeros((self.HEIGHT, self.WIDTH), dtype=numpy.uint8)
+        self.outputDir = outputDir
+        self.latency = latency
+        self.realtime = realtime
+        self.keepFrames = keepFrames
+        self.frames = []
+        self.showCount = 0
+        self.simulatedTime = 0.0
+
+        self._palette = panelPalette(colour)
+
+    def set_border(self, colour):
+        if colour not in (self.WHITE, self.BLACK, self.RED):
+            raise ValueError("Invalid border colour %s" % colour)
+        self.border_colour = colour
+
+    def set_image(self, image):
+        # Same as the driver: paletized images are used as-is, anything
+        # else is dithered onto the panel's three colours
+        if image.mode != "P":
+            image = palettize(image, self.colour)
+
+        canvas = Image.new("P", self.resolution)
+        canvas.paste(image, (0, 0))
+        self.buf = numpy.array(canvas, dtype=numpy.uint8)
+
+    def getImage(self):
+        """Return the current buffer as a viewable paletized image."""
+        frame = Image.fromarray(self.buf, "P")
+        frame.putpalette(self._palette)
+        return frame
+
+    def show(self, busy_wait=True):
+        if self.realtime and busy_wait:
+            time.sleep(self.latency)
+        self.simulatedTime += self.latency
+        self.showCount += 1
+
+        if self.keepFrames:
+            self.frames.append(self.buf.tobytes())
+        if self.outputDir is not None:
+            os.makedirs(self.outputDir, exist_ok=True)
+            self.getImage().save(os.path.join(self.outputDir, "frame-%04i.png" % self.showCount))
@@ -0,0 +1,94 @@
+import os
+import time
+
+# Import dependancies
+from PIL import Image
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Get the current path
+PATH = os.path.dirname(__file__)
+
+# Palette indices supported by the Inky pHAT (WHITE, BLACK, RED)
+INKY_COLOURS = (0, 1, 2)
+
+# Lookup tables are only 256 entries, so keep one per set of allowed colours
+_lutCache = {}
+
+
+def _getLut(allowed):
+    key = frozenset(allowed)
+    lut = _lutCache.get(key)
+    if lut is None:
+        lut = [255 if i in key else 0 for i in range(256)]
+        _lutCache[key] = lut
+    return lut
+
+
+def create_mask(source, allowed=INKY_COLOURS):
+    """Create a transparency mask.
+
+    Takes a source image and converts it into a mask permitting all the
+    colours supported by Inky pHAT (0, 1, 2) or an optional list of
+    allowed colours.
+
+    Paletized and greyscale images are mapped through a lookup table in a
+    single pass. Other modes compare whole pixels with NumPy, so allowed
+    colours should be given as tuples matching the image bands.
+
+    :param source: PIL image to build the mask from.
+    :param allowed: Optional list of Inky pHAT colours to allow.
+
+    """
+    if source.mode in ("P", "L"):
+        return source.point(_getLut(allowed), "1")
+
+    if numpy is None:
+        raise RuntimeError("Masking %s images requires the numpy module" % source.mode)
+
+    pixels = numpy.asarray(source)
+    if pixels.ndim == 2:
+        keep = numpy.isin(pixels, list(allowed))
+    else:
+        keep = numpy.zeros(pixels.shape[:2], dtype=bool)
+        for colour in allowed:
+            keep |= numpy.all(pixels == numpy.asarray(colour, dtype=pixels.dtype), axis=-1)
+
+    return Image.fromarray(keep.astype(numpy.uint8) * 255, "L").convert("1", dither=Image.NONE)
+
+
+if __name__ == "__main__":
+    import glob
+
+    def loopMask(source, allowed=INKY_COLOURS):
+        # Reference copy of the per-pixel loop this module replaces
+        mask_image = Image.new("1", source.size)
+        w, h = source.size
+        for x in range(w):
+            for y in range(h):
+                p = source.getpixel((x, y))
+                if p in allowed:
+                    mask_image.putpixel((x, y), 255)
+        return mask_image
+
+    icons = []
+    for icon in sorted(glob.glob(os.path.join(PATH, "resources/icons/*/*.png"))):
+        icons.append(Image.open(icon))
+        icons[-1].load()
+
+    rounds = 20
+    for name, maskFunc in (("loop", loopMask), ("lut", create_mask)):
+        start = time.perf_counter()
+        for i in range(rounds):
+            for icon in icons:
+                maskFunc(icon)
+        elapsed = time.perf_counter() - start
+        print("%-5s %8.3f ms per icon set" % (name, 1000 * elapsed / rounds))
+
+    # Make sure both methods agree before trusting the numbers
+    for icon in icons:
+        if loopMask(icon).tobytes() != create_mask(icon).tobytes():
+            raise RuntimeError("Mask mismatch for %s" % icon.filename)
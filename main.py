@@ -5,8 +5,8 @@ from sys import exit
 # Import dependancies
 from PIL import Image, ImageDraw, ImageFont
 from font_fredoka_one import FredokaOne
-from inky import eeprom
-from inky import phat
+from inkyDisplay import InkyConnect
+from frameGuard import FrameGuardClass
 from weather import WeatherManagerClass
 
 # Import secrets
@@ -17,17 +17,10 @@ DEBUG = True
 
 # Get the current path
 PATH = os.path.dirname(__file__)
+CACHE = "/home/" + Secrets.username + "/.cache/Inky/"
 
 # Connect to the Inky Display
-_eeprom = eeprom.read_eeprom()
-if _eeprom is None:
-    raise RuntimeError("No EEPROM detected! You must manually initialise your Inky board.")
-elif _eeprom.display_variant != 11:
-    if DEBUG:
-        print("Found eeprom id " + _eeprom.display_variant)
-    raise RuntimeError("Display is not the expected variant")
-
-display = phat.InkyPHAT_SSD1608("red")
+display = FrameGuardClass(InkyConnect("red"), CACHE)
 WeatherManager = WeatherManagerClass(display)
 
 # Initial boot, print the InkyPhat Logo
@@ -0,0 +1,48 @@
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class OpenMeteoClass:
+    """Small Open Meteo (https://open-meteo.com) forecast client.
+
+    Current conditions, the daily summary and the hourly series all come
+    back from a single gzip'ed request, sent over one keep-alive session
+    so repeated fetches from a long running process reuse the connection.
+    """
+
+    URL = "https://api.open-meteo.com/v1/forecast"
+    DAILY = ["weather_code", "temperature_2m_max", "temperature_2m_min", "apparent_temperature_max", "apparent_temperature_min"]
+    HOURLY = ["temperature_2m", "apparent_temperature", "weather_code"]
+
+    # (connect, read) timeouts in seconds
+    TIMEOUT = (3.05, 10)
+
+    def __init__(self, timezone="America/Chicago", forecastDays=1, timeout=TIMEOUT):
+        self.timezone = timezone
+        self.forecastDays = forecastDays
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.headers.update({"Accept-Encoding": "gzip", "Connection": "keep-alive"})
+        self.session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=1))
+
+    def close(self):
+        self.session.close()
+
+    def fetch(self, coords):
+        """Fetch current, daily and hourly data for a [latitude, longitude] pair.
+
+        Raises requests.RequestException if the request fails.
+        """
+        params = {
+            "latitude": coords[0],
+            "longitude": coords[1],
+            "current_weather": "true",
+            "daily": ",".join(self.DAILY),
+            "hourly": ",".join(self.HOURLY),
+            "timezone": self.timezone,
+            "forecast_days": self.forecastDays,
+            "timeformat": "unixtime",
+        }
+        res = self.session.get(self.URL, params=params, timeout=self.timeout)
+        res.raise_for_status()
+        return res.json()
@@ -0,0 +1,200 @@
+import time
+import argparse
+import subprocess
+from datetime import datetime, timedelta, timezone
+
+# Import dependancies
+from PiSugar import PiSugarConnect
+from inkyDisplay import InkyConnect
+from frameGuard import FrameGuardClass
+from diskCache import getCache
+
+# Import secrets
+from secrets import Secrets
+
+# Debug boolean
+DEBUG = True
+
+# Get the current path
+CACHE = "/home/" + Secrets.username + "/.cache/Inky/"
+
+
+class PowerSchedulerClass:
+    """Works out when the display next needs refreshing and sleeps until then.
+
+    The weather is refreshed every interval seconds (aligned to local
+    midnight) within the active hours, and XKCD is checked once on each of
+    its publishing days. nextWake picks the earliest of those, then
+    sleep programs the PiSugar's timed bootup for it and powers the Pi off,
+    so the Pi only runs for as long as there is something new to show.
+    The refreshes due at the wake are saved in the cache, so that on boot
+    runDue knows whether to draw the weather, the comic or both.
+
+    Usage::
+
+        scheduler = PowerSchedulerClass(PiSugarConnect())
+        scheduler.runDue(display)
+        scheduler.run(display)
+    """
+
+    # Seconds between weather refreshes
+    WEATHER_INTERVAL = 3600
+    # Local hours [first, last) in which the weather is worth refreshing
+    ACTIVE_HOURS = (6, 23)
+    # XKCD publishes on Monday, Wednesday and Friday (datetime weekday numbers)
+    XKCD_DAYS = (0, 2, 4)
+    # Local hour to check for the new comic, it is up by then
+    XKCD_HOUR = 6
+    # Not worth a shutdown and boot for less than this many seconds
+    MIN_SLEEP = 600
+    # Seconds the PiSugar waits before cutting the power, time enough to halt
+    SHUTDOWN_DELAY = 30
+    # Cache key of the planned wake and the refreshes due then
+    STATE_KEY = "powerSchedule.json"
+    # A boot this close to the planned wake (boot time, clock drift) is that wake
+    WAKE_SLACK = 900
+
+    def __init__(self, sugar, interval=WEATHER_INTERVAL, activeHours=ACTIVE_HOURS, xkcdDays=XKCD_DAYS, xkcdHour=XKCD_HOUR, cache=None):
+        self.sugar = sugar
+        self.interval = interval
+        self.activeHours = activeHours
+        self.xkcdDays = xkcdDays
+        self.xkcdHour = xkcdHour
+        self.cache = cache if cache is not None else getCache(CACHE)
+
+    def nextWeather(self, now):
+        midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        slot = midnight + timedelta(seconds=((now - midnight).total_seconds() // self.interval + 1) * self.interval)
+        first, last = self.activeHours
+        if slot.hour >= last or slot.date() != now.date():
+            return (midnight + timedelta(days=1)).replace(hour=first)
+        if slot.hour < first:
+            return slot.replace(hour=first, minute=0, second=0)
+        return slot
+
+    def nextXkcd(self, now):
+        for days in range(8):
+            check = (now + timedelta(days=days)).replace(hour=self.xkcdHour, minute=0, second=0, microsecond=0)
+            if check > now and check.weekday() in self.xkcdDays:
+                return check
+        return None
+
+    def nextWake(self, now=None):
+        """Return (local datetime of the next refresh, names of the refreshes due then)."""
+        if now is None:
+            now = datetime.now().astimezone()
+        candidates = {"weather": self.nextWeather(now), "xkcd": self.nextXkcd(now)}
+        wake = min(when for when in candidates.values() if when is not None)
+        return wake, sorted(name for name, when in candidates.items() if when == wake)
+
+    def saveWake(self, wake, reasons):
+        self.cache.putJson(self.STATE_KEY, {"wake": wake.timestamp(), "reasons": reasons}, pinned=True)
+
+    def dueRefreshes(self, now=None):
+        """Refreshes this boot was woken up for, just the weather after any other boot."""
+        if now is None:
+            now = time.time()
+        state = self.cache.getJson(self.STATE_KEY, allowStale=True)
+        if state is not None and abs(now - state["wake"]) <= self.WAKE_SLACK:
+            return state["reasons"]
+        return ["weather"]
+
+    def runDue(self, display, reasons=None):
+        """Draw the refreshes due now, the comic last so it stays up until the next wake."""
+        # Imported here, they pull in the network clients only a boot needs
+        from weather import WeatherManagerClass
+        from xkcdFetch import XkcdClass
+
+        if reasons is None:
+            reasons = self.dueRefreshes()
+        if DEBUG:
+            print("Running %s" % " and ".join(reasons))
+        xkcd = XkcdClass(display, refresh=False) if "xkcd" in reasons else None
+        if "weather" in reasons:
+            # Fetches the comic alongside the weather when both are due
+            WeatherManagerClass(display, self.sugar).doWeatherUpdate(xkcd=xkcd)
+        elif xkcd is not None:
+            xkcd.refresh()
+        if xkcd is not None:
+            xkcd.displayImage()
+
+    def sleep(self, wake, reasons, dryRun=False, syncClock=False):
+        """Program the timed bootup for wake and shut down, returns False if staying up.
+
+        :param wake: Aware datetime to power back on at.
+        :param reasons: Refreshes due at wake, saved for runDue on the next boot.
+        :param dryRun: Only print what would be done.
+        :param syncClock: Copy the system time to the PiSugar's RTC first.
+
+        """
+        if not self.sugar.isAvailable():
+            print("ERR: No PiSugar, nothing to wake the Pi up again")
+            return False
+        seconds = (wake - datetime.now(timezone.utc)).total_seconds()
+        if seconds < self.MIN_SLEEP:
+            print("Info: Next refresh in %i s, staying up" % seconds)
+            return False
+        if self.sugar.getSample(samples=1).supplied:
+            print("Info: On external power, staying up")
+            return False
+
+        if dryRun:
+            print("Dry run: would wake at %s and shut down" % wake.strftime("%a %H:%M:%S"))
+            return True
+
+        if syncClock:
+            self.sugar.setRTC()
+        self.sugar.setTimedBootup(wake)
+        enabled, weekdays, hour, minute, second = self.sugar.getTimedBootup()
+        if DEBUG:
+            print("Timed bootup %s: weekdays 0x%02X at %02i:%02i:%02i UTC" % ("on" if enabled else "off", weekdays, hour, minute, second))
+        self.saveWake(wake, reasons)
+        self.sugar.delayedShutdown(self.SHUTDOWN_DELAY)
+        subprocess.run(["sudo", "shutdown", "-h", "now"])
+        return True
+
+    def run(self, display, dryRun=False, syncClock=False):
+        """Plan the next refresh and power off until then.
+
+        Whenever sleep decides to stay up (external power, a refresh close
+        by, no PiSugar), wait for the refresh here, draw it and plan again,
+        so the display keeps updating without a reboot.
+        """
+        while True:
+            wake, reasons = self.nextWake()
+            print("Next refresh: %s at %s" % (" and ".join(reasons), wake.strftime("%a %d %b %H:%M")))
+            if self.sleep(wake, reasons, dryRun=dryRun, syncClock=syncClock) or dryRun:
+                return
+            time.sleep(max(0.0, (wake - datetime.now(timezone.utc)).total_seconds()))
+            try:
+                self.runDue(display, reasons)
+            except Exception as err:
+                # One failed refresh must not stop the ones after it
+                print("ERR: Refresh failed: %r" % err)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sleep until the display next needs refreshing")
+    parser.add_argument("--interval", type=int, default=PowerSchedulerClass.WEATHER_INTERVAL, help="Seconds between weather refreshes")
+    parser.add_argument("--sync-rtc", action="store_true", help="Set the PiSugar clock from the system time first")
+    parser.add_argument("--dry-run", action="store_true", help="Print the next wake up without programming it or shutting down")
+    parser.add_argument("--status", action="store_true", help="Print the PiSugar clock and timed bootup, then exit")
+    parser.add_argument("--boot", action="store_true", help="Draw the refreshes this wake up was for before sleeping again")
+    args = parser.parse_args()
+
+    PiSugar = PiSugarConnect()
+    if args.status:
+        print("RTC: %s" % PiSugar.getRTC())
+        if PiSugar.isAvailable():
+            enabled, weekdays, hour, minute, second = PiSugar.getTimedBootup()
+            print("Timed bootup %s: weekdays 0x%02X at %02i:%02i:%02i UTC" % ("on" if enabled else "off", weekdays, hour, minute, second))
+    else:
+        scheduler = PowerSchedulerClass(PiSugar, args.interval)
+        display = FrameGuardClass(InkyConnect("red"), CACHE)
+        try:
+            display.set_border(display.BLACK)
+        except NotImplementedError:
+            pass
+        if args.boot:
+            scheduler.runDue(display)
+        scheduler.run(display, dryRun=args.dry_run, syncClock=args.sync_rtc)
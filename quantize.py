@@ -0,0 +1,90 @@
+import numpy
+from PIL import Image, ImageFilter
+
+MODES = ("threshold", "bayer", "floyd-steinberg")
+
+# Spread of the ordered dither around each pixel, in 0-255 steps
+BAYER_SPREAD = 160
+
+_paletteImages = {}
+_bayerMatrices = {}
+
+
+def panelPalette(colour="red"):
+    """Return the white, black, colour palette of a panel variant as a flat RGB list."""
+    r, g, b = 0, 0, 0
+    if colour == "red":
+        r = 255
+    elif colour == "yellow":
+        r = g = 255
+    return [255, 255, 255, 0, 0, 0, r, g, b]
+
+
+def _paletteImage(colour):
+    if colour not in _paletteImages:
+        paletteImage = Image.new("P", (1, 1))
+        paletteImage.putpalette(panelPalette(colour) + [0, 0, 0] * 253)
+        _paletteImages[colour] = paletteImage
+    return _paletteImages[colour]
+
+
+def bayerMatrix(order=4):
+    """Return the order x order Bayer threshold map, scaled to [0, 1)."""
+    if order not in _bayerMatrices:
+        matrix = numpy.zeros((1, 1))
+        while matrix.shape[0] < order:
+            matrix = numpy.block([[4 * matrix, 4 * matrix + 2], [4 * matrix + 3, 4 * matrix + 1]])
+        _bayerMatrices[order] = matrix / matrix.size
+    return _bayerMatrices[order]
+
+
+def _orderedDither(image, colour, order=4):
+    rgb = numpy.asarray(image.convert("RGB"), dtype=numpy.float32)
+    height, width, _ = rgb.shape
+
+    # Offset every pixel by its threshold, then take the nearest panel colour
+    matrix = bayerMatrix(order)
+    offsets = numpy.tile(matrix - 0.5, (height // order + 1, width // order + 1))[:height, :width]
+    rgb = rgb + BAYER_SPREAD * offsets[:, :, None]
+    palette = numpy.array(panelPalette(colour), dtype=numpy.float32).reshape(-1, 3)
+    distance = ((rgb[:, :, None, :] - palette[None, None, :, :]) ** 2).sum(axis=3)
+
+    frame = Image.fromarray(distance.argmin(axis=2).astype(numpy.uint8), "P")
+    frame.putpalette(panelPalette(colour))
+    return frame
+
+
+def palettize(image, colour="red", mode="floyd-steinberg"):
+    """Map an image onto the panel's palette.
+
+    The result is a "P" image holding the display's colour indices, which
+    set_image uses as-is, so it can be stored and shown again later
+    without any further conversion.
+
+    :param image: Any PIL image, usually display sized.
+    :param colour: Panel colour variant, as passed to the inky driver.
+    :param mode: "threshold" (nearest colour, crisp line art), "bayer"
+        (ordered dither, stable patterns) or "floyd-steinberg" (error
+        diffusion, what the driver does for non paletized images).
+
+    """
+    if mode == "threshold":
+        return image.convert("RGB").quantize(palette=_paletteImage(colour), dither=Image.NONE)
+    elif mode == "bayer":
+        return _orderedDither(image, colour)
+    elif mode == "floyd-steinberg":
+        return image.convert("RGB").quantize(palette=_paletteImage(colour), dither=Image.FLOYDSTEINBERG)
+    raise ValueError("Unknown quantize mode %s" % mode)
+
+
+def quantizeError(source, frame, radius=1.5):
+    """Mean absolute RGB error (0-255) between a source and its paletized frame.
+
+    Both are blurred first, roughly like an eye at viewing distance, so
+    dithering is credited for reproducing tones rather than punished for
+    not matching pixel by pixel.
+    """
+    blur = ImageFilter.GaussianBlur(radius)
+    sourceArray = numpy.asarray(source.convert("RGB").filter(blur), dtype=numpy.float32)
+    frameArray = numpy.asarray(frame.convert("RGB").filter(blur), dtype=numpy.float32)
+    return float(numpy.abs(sourceArray - frameArray).mean())
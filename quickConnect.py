@@ -1,29 +1,170 @@
-import socket, os, time
+import os
+import json
+import time
+import socket
+import threading
+import subprocess
 
-def checkInternet(host="1.1.1.1", port=53, timeout=3):
-    """
-    Host: 1.1.1.1 (cloudflare dns)
-    OpenPort: 53/tcp
-    Service: domain (DNS/TCP)
+# Import secrets
+from secrets import Secrets
+
+# Get the current path
+CACHE = "/home/" + Secrets.username + "/.cache/Inky/"
+
+
+class ConnectivityManagerClass:
+    """Cached internet reachability with a non-blocking Bluetooth tether.
+
+    Reachability is answered from a cached state for TTL seconds (also
+    across processes, through connectivity.json). When the probe fails, the
+    Bluetooth tether is brought up by a detached shell in the background
+    instead of blocking the caller. Repeated tether attempts back off
+    exponentially between BACKOFF_MIN and BACKOFF_MAX seconds, and a
+    watcher thread re-probes once the tether commands finish.
     """
-    try:
-        socket.setdefaulttimeout(timeout)
-        socket.socket(socket.AF_INET, socket.SOCK_STREAM).connect((host, port))
-        return True
-    except socket.error as ex:
-        print(ex)
+
+    STATE_NAME = "connectivity.json"
+    TTL = 60
+    BACKOFF_MIN = 60
+    BACKOFF_MAX = 3600
+    # Longest the tether commands may take before the watcher gives up
+    TETHER_TIMEOUT = 30
+
+    def __init__(self, cacheDir=CACHE, host="1.1.1.1", port=53, timeout=3):
+        """
+        Host: 1.1.1.1 (cloudflare dns)
+        OpenPort: 53/tcp
+        Service: domain (DNS/TCP)
+        """
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.stateFile = os.path.join(cacheDir, self.STATE_NAME)
+        self._lock = threading.Lock()
+        self._tether = None
+        self._watcher = None
+        self.state = {"online": False, "checked": 0.0, "failures": 0, "nextTether": 0.0}
+        self._loadState()
+
+    def _loadState(self):
+        try:
+            with open(self.stateFile, "r") as stateFid:
+                self.state.update(json.load(stateFid))
+        except (OSError, ValueError):
+            pass
+
+    def _saveState(self):
+        try:
+            os.makedirs(os.path.dirname(self.stateFile), exist_ok=True)
+            with open(self.stateFile + ".tmp", "w") as stateFid:
+                json.dump(self.state, stateFid)
+            os.replace(self.stateFile + ".tmp", self.stateFile)
+        except OSError as err:
+            print("ERR: Could not save connectivity state: %s" % err)
+
+    def probe(self):
+        """Check reachability now, without touching the process-wide socket timeout."""
+        try:
+            with socket.create_connection((self.host, self.port), timeout=self.timeout):
+                online = True
+        except OSError as ex:
+            print(ex)
+            online = False
+
+        with self._lock:
+            self.state["online"] = online
+            self.state["checked"] = time.time()
+            if online:
+                self.state["failures"] = 0
+                self.state["nextTether"] = 0.0
+            self._saveState()
+        return online
+
+    def isOnline(self, maxAge=None):
+        """Return the cached reachability, probing only once it is older than maxAge.
+
+        When offline, a Bluetooth tether is started in the background (if the
+        backoff allows it); the answer is still returned straight away.
+        """
+        if maxAge is None:
+            maxAge = self.TTL
+        if time.time() - self.state["checked"] < maxAge:
+            return self.state["online"]
+
+        if self.probe():
+            return True
         print("ERR: Couldn't connect to wifi, trying bluetooth tethering")
+        self.startTether()
+        return False
+
+    def tetherPending(self):
+        return self._tether is not None and self._tether.poll() is None
+
+    def startTether(self):
+        """Start bringing up the Bluetooth tether without waiting for it.
+
+        Returns False if a tether attempt is already running or backing off.
+        """
+        with self._lock:
+            now = time.time()
+            if self.tetherPending() or now < self.state["nextTether"]:
+                return False
+
+            # Count the attempt up front, a successful probe resets it
+            self.state["failures"] += 1
+            delay = min(self.BACKOFF_MAX, self.BACKOFF_MIN * 2 ** (self.state["failures"] - 1))
+            self.state["nextTether"] = now + delay
+            self._saveState()
+
+        deviceid = Secrets.deviceid
+        commands = " && ".join([
+            "bluetoothctl connect %s" % deviceid,
+            "busctl call org.bluez /org/bluez/hci0/dev_%s org.bluez.Network1 Connect s nap" % deviceid,
+            "sudo dhclient -v bnep0",
+        ])
         try:
-            os.system("bluetoothctl connect %s" % Secrets.deviceid)
-            time.sleep(1.0)
-            os.system("busctl call org.bluez /org/bluez/hci0/dev_%s org.bluez.Network1 Connect s nap" % Secrets.deviceid)
-            time.sleep(0.5)
-            os.system("sudo dhclient -v bnep0")
-            time.sleep(0.5)
-            return False
-        except:
-            print("Couldn't create Bluetooth tether")
+            # Detached, so the tether still comes up if this process exits first
+            self._tether = subprocess.Popen(commands, shell=True, start_new_session=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        except OSError as err:
+            print("Couldn't create Bluetooth tether: %s" % err)
             return False
 
+        self._watcher = threading.Thread(target=self._watchTether, args=(self._tether,), name="tether-watch", daemon=True)
+        self._watcher.start()
+        return True
+
+    def _watchTether(self, tether):
+        try:
+            tether.wait(self.TETHER_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            print("ERR: Bluetooth tether is taking too long")
+            return
+        self.probe()
+
+    def waitForTether(self, timeout=None):
+        """Block until a running tether attempt has been re-checked, then return reachability."""
+        if self._watcher is not None:
+            self._watcher.join(timeout)
+        return self.state["online"]
+
+
+_manager = None
+
+
+def getConnectivityManager():
+    global _manager
+    if _manager is None:
+        _manager = ConnectivityManagerClass()
+    return _manager
+
+
+def checkInternet(maxAge=None):
+    """Return whether the internet is reachable, from the cache when fresh."""
+    return getConnectivityManager().isOnline(maxAge)
+
+
 if __name__ == "__main__":
-    print(checkInternet())
\ No newline at end of file
+    manager = getConnectivityManager()
+    print(manager.isOnline(maxAge=0))
+    if manager.tetherPending():
+        print(manager.waitForTether(manager.TETHER_TIMEOUT))
@@ -0,0 +1,153 @@
+import time
+import argparse
+from collections import namedtuple
+
+# Import dependancies
+from PiSugar import PiSugarConnect, PiSugarClass, fromBCD
+
+# A decoded register field: the registers it is read from, and how to turn them into a value
+RegisterField = namedtuple("RegisterField", ["registers", "decode", "static"])
+# A field that changed between two polls
+RegisterEvent = namedtuple("RegisterEvent", ["timestamp", "field", "old", "new"])
+
+_reg = PiSugarClass._registerMap
+
+
+def _bit(register, bit):
+    return RegisterField((register.value,), lambda regs: (regs[register.value] >> bit) & 1 == 1, False)
+
+
+def _rtc(regs):
+    return "20%02i-%02i-%02i %02i:%02i:%02i" % tuple(fromBCD(regs[register.value]) for register in (_reg.RTC_Year, _reg.RTC_Month, _reg.RTC_Day, _reg.RTC_Hour, _reg.RTC_Minute, _reg.RTC_Second))
+
+
+def _firmware(regs):
+    return bytes(regs[_reg.FW_Version_0.value:_reg.FW_Version_B.value + 1]).split(b"\0")[0].decode("ascii", "replace")
+
+
+FIELDS = {
+    "externalPower":     _bit(_reg.PowerCtrl, 7),
+    "chargeWhenPowered": _bit(_reg.PowerCtrl, 6),
+    "delayedShutdown":   _bit(_reg.PowerCtrl, 5),
+    "autoPowerOn":       _bit(_reg.PowerCtrl, 4),
+    "touchControl":      _bit(_reg.PowerCtrl, 3),
+    "powerOn":           _bit(_reg.PowerCtrl, 2),
+    "powerButton":       _bit(_reg.PowerCtrl, 0),
+    "autoHibernate":     _bit(_reg.PowerCtrl2, 6),
+    "softShutdown":      _bit(_reg.PowerCtrl2, 4),
+    "softShutdownState": _bit(_reg.PowerCtrl2, 3),
+    "chargeProtection":  _bit(_reg.ChargeCtrl, 7),
+    "timedBootup":       _bit(_reg.TimedBootup, 7),
+    "temperature": RegisterField((_reg.Temperature.value,), lambda regs: regs[_reg.Temperature.value] - PiSugarClass.TEMPERATURE_OFFSET, False),
+    "writeProtect": RegisterField((_reg.WriteProtect.value,), lambda regs: regs[_reg.WriteProtect.value] != 0x29, False),
+    "voltage": RegisterField((_reg.BatteryUpper.value, _reg.BatteryLower.value), lambda regs: round(((regs[_reg.BatteryUpper.value] << 8) + regs[_reg.BatteryLower.value]) / 1007.0, 3), False),
+    "energy": RegisterField((_reg.EnergyLevel.value,), lambda regs: regs[_reg.EnergyLevel.value], False),
+    "rtc": RegisterField(tuple(range(_reg.RTC_Year.value, _reg.RTC_Second.value + 1)), _rtc, False),
+    "bootupTime": RegisterField(tuple(range(_reg.Boot_Weekday.value, _reg.Boot_Second.value + 1)), lambda regs: "0x%02X %02i:%02i:%02i" % (regs[_reg.Boot_Weekday.value], fromBCD(regs[_reg.Boot_Hour.value]), fromBCD(regs[_reg.Boot_Minute.value]), fromBCD(regs[_reg.Boot_Second.value])), False),
+    "firmware": RegisterField(tuple(range(_reg.FW_Version_0.value, _reg.FW_Version_B.value + 1)), _firmware, True),
+}
+
+# The seconds tick on every poll, leave the clock out unless asked for
+DEFAULT_FIELDS = [name for name in FIELDS if name != "rtc"]
+
+
+def mergeWindows(registers, gap=4, limit=32):
+    """Group register addresses into as few (start, length) block reads as possible.
+
+    Registers less than gap apart share a read, as long as it stays within
+    the SMBus block limit.
+    """
+    windows = []
+    for register in sorted(set(registers)):
+        if windows:
+            start, length = windows[-1]
+            if register - (start + length) < gap and register - start < limit:
+                windows[-1] = (start, register - start + 1)
+                continue
+        windows.append((register, 1))
+    return windows
+
+
+class RegisterMonitorClass:
+    """Watches named PiSugar register fields and reports their changes.
+
+    Only the register windows the chosen fields (and any extra windows)
+    live in are read, each in a single block transaction, instead of
+    dumping all 256 registers. Static fields such as the firmware string
+    are read on the first poll only. Each poll decodes the fields and
+    returns a timestamped RegisterEvent for every value that changed.
+
+    Usage::
+
+        monitor = RegisterMonitorClass(PiSugarConnect(), ["externalPower", "temperature"])
+        for event in monitor.poll():
+            print(event)
+    """
+
+    def __init__(self, sugar, fields=DEFAULT_FIELDS, extraWindows=()):
+        self.sugar = sugar
+        self.fields = {name: FIELDS[name] for name in fields}
+        self.image = [0] * 256
+        # Registers of image that hold a value read from the bus
+        self.known = set()
+        self.values = {}
+        self.polls = 0
+        self.transactions = 0
+
+        registers = set()
+        staticRegisters = set()
+        for field in self.fields.values():
+            (staticRegisters if field.static else registers).update(field.registers)
+        for start, length in extraWindows:
+            registers.update(range(start, start + length))
+        self.windows = mergeWindows(registers)
+        self.staticWindows = mergeWindows(staticRegisters - registers)
+
+    def read(self):
+        """Refresh the register image from the bus, returns the windows read."""
+        windows = self.windows + (self.staticWindows if self.polls == 0 else [])
+        for start, length in windows:
+            self.image[start:start + length] = self.sugar.readWindow(start, length)
+            self.known.update(range(start, start + length))
+            self.transactions += 1
+        self.polls += 1
+        return windows
+
+    def decode(self):
+        return {name: field.decode(self.image) for name, field in self.fields.items()}
+
+    def poll(self):
+        """Read, decode and return the RegisterEvents since the previous poll.
+
+        The first poll reports every field, with None as the old value.
+        """
+        self.read()
+        now = time.time()
+        events = []
+        for name, value in self.decode().items():
+            old = self.values.get(name)
+            if name not in self.values or old != value:
+                events.append(RegisterEvent(now, name, old, value))
+            self.values[name] = value
+        return events
+
+    def watch(self, interval, callback, polls=None):
+        """Poll every interval seconds, handing every event to callback."""
+        count = 0
+        while polls is None or count < polls:
+            for event in self.poll():
+                callback(event)
+            count += 1
+            if polls is None or count < polls:
+                time.sleep(interval)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Print PiSugar register changes as they happen")
+    parser.add_argument("--interval", type=float, default=5.0, help="Seconds between polls")
+    parser.add_argument("--field", action="append", choices=sorted(FIELDS), help="Field to watch (repeatable), defaults to all but rtc")
+    args = parser.parse_args()
+
+    monitor = RegisterMonitorClass(PiSugarConnect(), args.field or DEFAULT_FIELDS)
+    print("Reading %s" % ", ".join("0x%02X-0x%02X" % (start, start + length - 1) for start, length in monitor.windows + monitor.staticWindows))
+    monitor.watch(args.interval, lambda event: print("%s %s: %s -> %s" % (time.strftime("%H:%M:%S", time.localtime(event.timestamp)), event.field, event.old, event.new)))
@@ -0,0 +1,39 @@
+import time
+from contextlib import contextmanager, nullcontext
+
+
+class StageTimerClass:
+    """Accumulates wall-clock time spent in named rendering stages.
+
+    Usage::
+
+        with timer.stage("resize"):
+            img = img.resize(size)
+
+    A disabled timer (see NULL_TIMER) costs next to nothing, so render
+    code can always be written against one.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.stages = {}
+
+    @contextmanager
+    def _timed(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - start
+
+    def stage(self, name):
+        if not self.enabled:
+            return nullcontext()
+        return self._timed(name)
+
+    def reset(self):
+        self.stages = {}
+
+
+# Shared do-nothing timer used when nobody is measuring
+NULL_TIMER = StageTimerClass(enabled=False)
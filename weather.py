@@ -1,15 +1,20 @@
 import os
-import glob
-import json
 import time
 import netifaces
+from bisect import bisect_right
 
 # Import dependancies
 from PIL import Image, ImageDraw, ImageFont
 from font_fredoka_one import FredokaOne
-from inky import eeprom
-from inky import phat
 from PiSugar import PiSugarConnect
+from inkyMask import create_mask
+from iconAtlas import IconAtlasClass
+from frameGuard import FrameGuardClass
+from inkyDisplay import InkyConnect
+from stageTimer import NULL_TIMER
+from fetchStage import FetchStageClass
+from forecastStore import ForecastStoreClass
+from diskCache import getCache
 from quickConnect import checkInternet
 
 # Import secrets
@@ -29,6 +34,9 @@ try:
 except ImportError:
     exit("This script requires the geocoder module\nInstall with: sudo pip install geocoder")
 
+from openMeteo import OpenMeteoClass
+from xkcdFetch import XkcdClass
+
 # Get the current path
 PATH = os.path.dirname(__file__)
 CACHE = "/home/" + Secrets.username + "/.cache/Inky/"
@@ -39,61 +47,143 @@ class WeatherManagerClass:
     CITY = Secrets.city
     COUNTRYCODE = Secrets.countrycode
     WARNING_TEMP = 25.0
+    # Cities don't move, so only re-check the geocoder every few months
+    GEOCODE_TTL = 90 * 86400
+    # Longest a whole update may spend gathering data, in seconds
+    FETCH_DEADLINE = 8.0
+    # Days of hourly forecast kept for when the network is down
+    FORECAST_DAYS = 7
+
+    def __init__(self, display, battery=None):
+        """
+        :param display: Inky display (or FrameGuardClass/simulator) to draw on.
+        :param battery: Connected PiSugar, connected on first use if omitted.
+            Start its sampler to have updates read the battery from memory.
 
-    def __init__(self, display):
+        """
         self.display = display
+        self.battery = battery
+        self.atlas = IconAtlasClass(CACHE, (display.WHITE, display.BLACK, display.RED))
+        self.timer = NULL_TIMER
+        self.client = OpenMeteoClass(forecastDays=self.FORECAST_DAYS)
+        self.cache = getCache(CACHE)
+        self.forecast = ForecastStoreClass(self.cache)
 
 
     # Convert a city name and country code to latitude and longitude
     def get_coords(self, address):
-        g = geocoder.arcgis(address)
-        coords = g.latlng
+        """Look up the coordinates for an address.
+
+        Secrets.latitude/longitude override the lookup when both are set.
+        Otherwise answers are cached in geocode.json, keyed by the
+        normalized address, for GEOCODE_TTL seconds. A stale entry is
+        still used when the geocoder can't be reached.
+        """
+        latitude = getattr(Secrets, "latitude", None)
+        longitude = getattr(Secrets, "longitude", None)
+        if latitude is not None and longitude is not None:
+            return [latitude, longitude]
+
+        key = ",".join(" ".join(part.split()) for part in address.lower().split(","))
+        cachedCoords = self.cache.getJson("geocode.json", allowStale=True) or {}
+
+        entry = cachedCoords.get(key)
+        if entry is not None and time.time() - entry["time"] < self.GEOCODE_TTL:
+            return entry["latlng"]
+
+        try:
+            g = geocoder.arcgis(address)
+            coords = g.latlng
+        except Exception as err:
+            print("ERR: Geocoder failed: %s" % err)
+            coords = None
+
+        if coords is None:
+            if entry is None:
+                raise RuntimeError("Could not find coordinates for %s" % address)
+            print("ERR: Couldn't reach the geocoder, using cached coordinates")
+            return entry["latlng"]
+
+        cachedCoords[key] = {"latlng": coords, "time": time.time()}
+        self.cache.putJson("geocode.json", cachedCoords, pinned=True)
         return coords
 
 
     # Query OpenMeteo (https://open-meteo.com) to get current weather data
     def get_weather(self, address):
-        coords = self.get_coords(address)
-        weather = {}
         if checkInternet():
-            res = requests.get("https://api.open-meteo.com/v1/forecast?latitude=" + str(coords[0]) + "&longitude=" + str(coords[1]) + "&current_weather=true&timezone=America%2FChicago&timeformat=unixtime")
+            try:
+                return self.fetch_weather(address)
+            except (requests.RequestException, ValueError) as err:
+                print("ERR: Could not fetch weather: %s" % err)
         else:
-            res = None
             print("ERR: couldn't tether via bluetooth")
             if DEBUG:
                 print(netifaces.interfaces())
+        return self.get_cached_weather()
+
+    def fetch_weather(self, address):
+        """Fetch the current weather online, refreshing the forecast cache.
+
+        Raises requests.RequestException if Open Meteo can't be reached.
+        """
+        coords = self.get_coords(address)
+        weather = {}
+        rawInfo = self.client.fetch(coords)
 
-        # If able to connect successfully, load from internet
         # If new day, update forecast cache
-        forecastFid = open(os.path.join(CACHE, "forecast.json"), "r")
-        cachedForecast = json.load(forecastFid)
-        forecastFid.close()
-        if (res != None)  and (res.status_code == 200):
-            rawInfo = json.loads(res.text)
-            current = rawInfo["current_weather"]
-            weather["current"] = True
-            weather["temperature"] = current["temperature"]
-            weather["windspeed"] = current["windspeed"]
-            weather["weathercode"] = current["weathercode"]
+        cachedForecast = self.cache.getJson("forecast.json", allowStale=True)
+
+        # Keep the hourly series for the offline screen
+        self.forecast.merge(rawInfo["hourly"])
+        self.forecast.save()
+
+        current = rawInfo["current_weather"]
+        weather["current"] = True
+        weather["temperature"] = current["temperature"]
+        weather["windspeed"] = current["windspeed"]
+        weather["weathercode"] = current["weathercode"]
+        if cachedForecast is not None:
             currentDay = int(time.strftime('%d', time.localtime(current["time"])))
             cachedDay = int(time.strftime('%d', time.localtime(cachedForecast["time"][0])))
-            if (currentDay != cachedDay) or (current["time"] - cachedForecast["time"][0] > 86400):
-                # Present day is not the same calendar day as cached day, or interval between current and
-                # cached is more than one day to account for sitting off for exactly one month.
-                print("Today's forcast is out of date. Updating now")
-                res = requests.get("https://api.open-meteo.com/v1/forecast?latitude=" + str(coords[0]) + "&longitude=" + str(coords[1]) + "&daily=weather_code,temperature_2m_max,temperature_2m_min,apparent_temperature_max,apparent_temperature_min&timezone=America%2FChicago&forecast_days=1&timeformat=unixtime")
-                rawInfo = json.loads(res.text)
-                forecast = rawInfo["daily"]
-                forecastFid = open(os.path.join(CACHE, "forecast.json"), "w")
-                forecastFid.write(json.dumps(forecast))
-                forecastFid.close()
-        else:
-            weather["current"] = False
-            weather["temperature_max"] = cachedForecast["temperature_2m_max"][0]
-            weather["temperature_min"] = cachedForecast["temperature_2m_min"][0]
-            weather["apparent_temperature_max"] = cachedForecast["apparent_temperature_max"][0]
-            weather["apparent_temperature_min"] = cachedForecast["apparent_temperature_min"][0]
-            weather["weathercode"] = cachedForecast["weather_code"][0]
+        if (cachedForecast is None) or (currentDay != cachedDay) or (current["time"] - cachedForecast["time"][0] > 86400):
+            # Present day is not the same calendar day as cached day, or interval between current and
+            # cached is more than one day to account for sitting off for exactly one month.
+            # Today's forecast came along with the current conditions, so no second request is needed.
+            print("Today's forcast is out of date. Updating now")
+            forecast = rawInfo["daily"]
+            self.cache.putJson("forecast.json", forecast, ttl=86400, pinned=True)
+        return weather
+
+    def get_cached_weather(self, now=None):
+        """Build the offline weather from the cached forecasts.
+
+        The hourly store gives the temperature and weather code for right
+        now, interpolated between the surrounding hours. Today's entry of
+        the cached daily forecast adds the highs and lows when available.
+        """
+        if now is None:
+            now = time.time()
+        weather = {}
+        weather["current"] = False
+
+        sample = self.forecast.lookup(now)
+        if sample is not None:
+            weather["estimated"] = True
+            weather["temperature"] = round(sample[0], 1)
+            weather["apparent_temperature"] = round(sample[1], 1)
+            weather["weathercode"] = sample[2]
+
+        cachedForecast = self.cache.getJson("forecast.json", allowStale=True)
+        if cachedForecast is not None:
+            day = max(bisect_right(cachedForecast["time"], now) - 1, 0)
+            weather["temperature_max"] = cachedForecast["temperature_2m_max"][day]
+            weather["temperature_min"] = cachedForecast["temperature_2m_min"][day]
+            weather["apparent_temperature_max"] = cachedForecast["apparent_temperature_max"][day]
+            weather["apparent_temperature_min"] = cachedForecast["apparent_temperature_min"][day]
+            weather.setdefault("weathercode", cachedForecast["weather_code"][day])
+
+        weather.setdefault("weathercode", None)
         return weather
 
 
@@ -107,143 +197,158 @@ class WeatherManagerClass:
         :param mask: Optional list of Inky pHAT colours to allow.
 
         """
-        mask=(self.display.WHITE, self.display.BLACK, self.display.RED)
-        mask_image = Image.new("1", source.size)
-        w, h = source.size
-        for x in range(w):
-            for y in range(h):
-                p = source.getpixel((x, y))
-                if p in mask:
-                    mask_image.putpixel((x, y), 255)
-
-        return mask_image
-
-    def doWeatherUpdate(self):
-        # Dictionaries to store our icons and icon masks in
-        icons = {}
-        masks = {}
-
-        # This maps the weather code from Open Meteo
-        # to the appropriate weather icons
-        # Weather codes from https://open-meteo.com/en/docs
-        icon_map = {
-            "snow": [71, 73, 75, 77, 85, 86],
-            "rain": [51, 53, 55, 56, 57, 61, 63, 65, 66, 67, 80, 81, 82],
-            "cloud": [1, 2, 3, 45, 48],
-            "sun": [0],
-            "storm": [95, 96, 99],
-            "wind": []
-        }
+        return create_mask(source, (self.display.WHITE, self.display.BLACK, self.display.RED))
+
+    def renderWeather(self, weather, battPerc, now=None):
+        """Draw the weather screen and return it as an image.
+
+        :param weather: Dictionary as returned by get_weather.
+        :param battPerc: Battery charge in percent.
+        :param now: Optional timestamp for the clock, defaults to now.
 
+        """
         # Placeholder variables
         windspeed = 0.0
         temperature = 0.0
         weather_icon = None
-
-        # Get the weather data for the given location
-        location_string = "{city}, {countrycode}".format(city=self.CITY, countrycode=self.COUNTRYCODE)
-        weather = self.get_weather(location_string)
-
-        PiSugar = PiSugarConnect()
+        timer = self.timer
 
         # Create a new canvas to draw on
-        img = Image.open(os.path.join(PATH, "resources/Background_250x122.png")).resize(self.display.resolution)
+        with timer.stage("asset load"):
+            img = Image.open(os.path.join(PATH, "resources/Background_250x122.png"))
+            img.load()
+        with timer.stage("resize"):
+            img = img.resize(self.display.resolution)
         draw = ImageDraw.Draw(img)
 
         # Load the FredokaOne font
-        font = ImageFont.truetype(FredokaOne, 22)
+        with timer.stage("asset load"):
+            font = ImageFont.truetype(FredokaOne, 22)
 
         # Write text with weather values to the canvas
-        datetime = time.strftime('%a %b %d %H:%M')
-        draw.text((38, 14), datetime, self.display.WHITE, font=font)
-
-        if weather["current"]:
-            wifiIcon = Image.open(os.path.join(PATH, "resources/icons/system/WifiGood1.png"))
-            temperature = weather["temperature"]
-            windspeed = weather["windspeed"]
-            weathercode = weather["weathercode"]
-
-            draw.text((83, 43), "T", self.display.WHITE, font=font)
-            draw.text((103, 43), "{}°C".format(temperature), self.display.WHITE if temperature < self.WARNING_TEMP else self.display.RED, font=font)
-
-            draw.text((80, 72), "W", self.display.WHITE, font=font)
-            draw.text((103, 72), "{}kmh".format(windspeed), self.display.WHITE, font=font)
-
-        else:
-            wifiIcon = Image.open(os.path.join(PATH, "resources/icons/system/WifiBad1_thick.png"))
-            print("Warning, no weather information found!")
-
-            high = weather["temperature_max"]
-            low = weather["temperature_min"]
-            feelsLikeHigh = weather["apparent_temperature_max"]
-            feelsLikeLow = weather["apparent_temperature_min"]
-            weathercode = weather["weathercode"]
+        with timer.stage("text draw"):
+            datetime = time.strftime('%a %b %d %H:%M', time.localtime(now))
+            draw.text((38, 14), datetime, self.display.WHITE, font=font)
+
+            if weather["current"]:
+                wifiIcon = "resources/icons/system/WifiGood1.png"
+                temperature = weather["temperature"]
+                windspeed = weather["windspeed"]
+                weathercode = weather["weathercode"]
+
+                draw.text((83, 43), "T", self.display.WHITE, font=font)
+                draw.text((103, 43), "{}°C".format(temperature), self.display.WHITE if temperature < self.WARNING_TEMP else self.display.RED, font=font)
+
+                draw.text((80, 72), "W", self.display.WHITE, font=font)
+                draw.text((103, 72), "{}kmh".format(windspeed), self.display.WHITE, font=font)
+
+            else:
+                wifiIcon = "resources/icons/system/WifiBad1_thick.png"
+                print("Warning, no weather information found!")
+
+                weathercode = weather["weathercode"]
+                draw.text((83, 43), "T", self.display.WHITE, font=font)
+                draw.text((80, 72), "F", self.display.WHITE, font=font)
+
+                if weather.get("estimated"):
+                    # Interpolated from the cached hourly forecast
+                    temperature = weather["temperature"]
+                    feelsLike = weather["apparent_temperature"]
+                    draw.text((103, 43), "~{}°C".format(temperature), self.display.WHITE if temperature < self.WARNING_TEMP else self.display.RED, font=font)
+                    draw.text((103, 72), "~{}°C".format(feelsLike), self.display.WHITE, font=font)
+
+                elif "temperature_max" in weather:
+                    high = weather["temperature_max"]
+                    low = weather["temperature_min"]
+                    feelsLikeHigh = weather["apparent_temperature_max"]
+                    feelsLikeLow = weather["apparent_temperature_min"]
+
+                    draw.text((103, 43), "{} | {}°C".format(high, low), self.display.WHITE if high < self.WARNING_TEMP else self.display.RED, font=font)
+                    draw.text((103, 72), "{} | {}°C".format(feelsLikeHigh, feelsLikeLow), self.display.WHITE, font=font)
+
+                else:
+                    draw.text((103, 43), "--°C", self.display.WHITE, font=font)
+                    draw.text((103, 72), "--°C", self.display.WHITE, font=font)
 
-            draw.text((83, 43), "T", self.display.WHITE, font=font)
-            draw.text((103, 43), "{} | {}°C".format(high, low), self.display.WHITE if high < self.WARNING_TEMP else self.display.RED, font=font)
+        # Draw the current weather icon over the backdrop
+        with timer.stage("mask"):
+            weather_icon = self.atlas.getWeatherIcon(weathercode)
+            if weather_icon is not None:
+                img.paste(weather_icon[0], (30, 45), weather_icon[1])
+
+            else:
+                draw.text((45, 55), "?", self.display.RED, font=font)
+
+            # Add Wifi icon
+            icon, mask = self.atlas.getIcon(wifiIcon)
+            img.paste(icon, (170, 1), mask)
+
+            # Add Battery icon & number (TODO)
+            if battPerc > 80.0:
+                battIcon = "resources/icons/system/Battery4.png"
+            elif battPerc > 60.0:
+                battIcon = "resources/icons/system/Battery3.png"
+            elif battPerc > 40.0:
+                battIcon = "resources/icons/system/Battery2.png"
+            elif battPerc > 20.0:
+                battIcon = "resources/icons/system/Battery1.png"
+            else:
+                battIcon = "resources/icons/system/BatteryEmpty.png"
+            icon, mask = self.atlas.getIcon(battIcon)
+            img.paste(icon, (190, 1), mask)
+            self.atlas.save()
 
-            draw.text((80, 72), "F", self.display.WHITE, font=font)
-            draw.text((103, 72), "{} | {}°C".format(feelsLikeHigh, feelsLikeLow), self.display.WHITE, font=font)
+        # Draw lines to frame the weather data
+        with timer.stage("text draw"):
+            draw.line((75, 41, 75, 100))       # Vertical line
+            draw.line((27, 41, 222, 41))      # Horizontal top line
+            draw.line((75, 70, 222, 70))      # Horizontal middle line
+            draw.line((207, 70, 207, 70), 2)  # Red seaweed pixel :D
 
-        # Load our icon files and generate masks
-        for icon in glob.glob(os.path.join(PATH, "resources/icons/weather/icon-*.png")):
-            icon_name = icon.split("icon-")[1].replace(".png", "")
-            icon_image = Image.open(icon)
-            icons[icon_name] = icon_image
-            masks[icon_name] = self.create_mask(icon_image)
+        return img
 
-        weather_icon = None
-        for icon in icon_map:
-            if weathercode in icon_map[icon]:
-                weather_icon = icon
-                break
+    def getBattery(self):
+        if self.battery is None:
+            self.battery = PiSugarConnect()
+        return self.battery
 
-        # Draw the current weather icon over the backdrop
-        if weather_icon is not None:
-            img.paste(icons[weather_icon], (30, 45), masks[weather_icon])
+    def gather(self, xkcd=None):
+        """Collect everything the weather screen needs, concurrently.
 
-        else:
-            draw.text((45, 55), "?", self.display.RED, font=font)
-
-        # Add Wifi icon
-        img.paste(wifiIcon, (170, 1), self.create_mask(wifiIcon))
-
-        # Add Battery icon & number (TODO)
-        battPerc = PiSugar.getBatteryPerc()
-        if battPerc > 80.0:
-            battIcon = Image.open(os.path.join(PATH, "resources/icons/system/Battery4.png"))
-        elif battPerc > 60.0:
-            battIcon = Image.open(os.path.join(PATH, "resources/icons/system/Battery3.png"))
-        elif battPerc > 40.0:
-            battIcon = Image.open(os.path.join(PATH, "resources/icons/system/Battery2.png"))
-        elif battPerc > 20.0:
-            battIcon = Image.open(os.path.join(PATH, "resources/icons/system/Battery1.png"))
-        else:
-            battIcon = Image.open(os.path.join(PATH, "resources/icons/system/BatteryEmpty.png"))
-        img.paste(battIcon, (190, 1), self.create_mask(battIcon))
+        Connectivity, weather, battery and (optionally) the XKCD metadata
+        are fetched side by side under FETCH_DEADLINE. Late or failing
+        sources fall back to cached values.
+        """
+        location_string = "{city}, {countrycode}".format(city=self.CITY, countrycode=self.COUNTRYCODE)
 
-        # Draw lines to frame the weather data
-        draw.line((75, 41, 75, 100))       # Vertical line
-        draw.line((27, 41, 222, 41))      # Horizontal top line
-        draw.line((75, 70, 222, 70))      # Horizontal middle line
-        draw.line((207, 70, 207, 70), 2)  # Red seaweed pixel :D
+        stage = FetchStageClass(CACHE, self.FETCH_DEADLINE)
+        stage.add("connectivity", checkInternet, fallback=lambda: False)
+        stage.add("weather", lambda: self.fetch_weather(location_string), fallback=self.get_cached_weather)
+        stage.add("battery", lambda: self.getBattery().getSample(samples=1).percent)
+        if xkcd is not None:
+            stage.add("xkcd", xkcd.refresh, fallback=lambda: None)
+        with self.timer.stage("fetch"):
+            results = stage.gather()
+
+        if not results["connectivity"] and DEBUG:
+            print(netifaces.interfaces())
+        if results["battery"] is None:
+            results["battery"] = 0
+        return results
+
+    def doWeatherUpdate(self, xkcd=None):
+        results = self.gather(xkcd)
+        img = self.renderWeather(results["weather"], results["battery"])
 
         # display the weather data on Inky pHAT
-        self.display.set_image(img)
+        with self.timer.stage("quantize"):
+            self.display.set_image(img)
         self.display.show()
 
 if __name__ == "__main__":
 
     # Connect to the Inky Display
-    _eeprom = eeprom.read_eeprom()
-    if _eeprom is None:
-        raise RuntimeError("No EEPROM detected! You must manually initialise your Inky board.")
-    elif _eeprom.display_variant != 11:
-        if DEBUG:
-            print("Found eeprom id " + _eeprom.display_variant)
-        raise RuntimeError("Display is not the expected variant")
-
-    display = phat.InkyPHAT_SSD1608("red")
+    display = FrameGuardClass(InkyConnect("red"), CACHE)
     WeatherManager = WeatherManagerClass(display)
 
     try:
@@ -251,4 +356,5 @@ if __name__ == "__main__":
     except NotImplementedError:
         pass
 
-    WeatherManager.doWeatherUpdate()
+    # Warm the XKCD cache while the network is up anyway
+    WeatherManager.doWeatherUpdate(xkcd=XkcdClass(refresh=False))
@@ -0,0 +1,169 @@
+import io
+import json
+import time
+import random
+import argparse
+import threading
+import urllib.request
+
+# Import dependancies
+from inkyDisplay import InkyConnect
+from quantize import palettize
+from frameGuard import FrameGuardClass
+from diskCache import getCache
+from xkcdFetch import XkcdClass, HEADER, formatComic, frameKey, storeFrame, loadFrame, loadComic
+
+# Import secrets
+from secrets import Secrets
+
+# Get the current path
+CACHE = "/home/" + Secrets.username + "/.cache/Inky/"
+
+
+class XkcdArchiveClass:
+    """Prefetched XKCD comics, kept as display ready frames.
+
+    prefetch pulls the latest comics (and optionally a random sample of
+    older ones), renders each one for the display and stores the
+    palettized frame in the disk cache under PREFIX. Frames past the
+    archive's byte budget are evicted least recently used first. showNext
+    rotates through whatever is stored, without touching the network.
+    """
+
+    PREFIX = "xkcd/archive/"
+    COMIC_URL = "https://xkcd.com/%i/info.0.json"
+    TIMEOUT = 10
+    # A frame is a few KB of paletized PNG, so this holds hundreds of comics
+    BUDGET = 2 * 1024 * 1024
+    LATEST = 10
+
+    def __init__(self, display, cache=None, latest=LATEST, randomSample=0, budget=BUDGET):
+        self.display = display
+        self.cache = getCache(CACHE) if cache is None else cache
+        self.latest = latest
+        self.randomSample = randomSample
+        self.budget = budget
+        self.bytesTransferred = 0
+        self._thread = None
+
+    def frameKey(self, num):
+        return frameKey(self.PREFIX, num, self.display.resolution, XkcdClass.QUANTIZE)
+
+    def comics(self):
+        """Numbers of the comics with a frame for this display and renderer, newest first."""
+        # Frames of other resolutions, modes or renderer versions are left to LRU eviction
+        suffix = self.frameKey(0)[len(self.PREFIX) + 1:]
+        keys = [key for key in list(self.cache.entries) if key.startswith(self.PREFIX) and key.endswith(suffix)]
+        return sorted((int(key[len(self.PREFIX):-len(suffix)]) for key in keys), reverse=True)
+
+    def candidates(self, latestNum):
+        """Comic numbers prefetch should have: the latest ones plus a random sample."""
+        newest = list(range(latestNum, max(0, latestNum - self.latest), -1))
+        older = range(1, max(1, latestNum - self.latest + 1))
+        sample = random.sample(older, min(self.randomSample, len(older)))
+        # There is no comic 404
+        return [num for num in newest + sample if num != 404]
+
+    def _fetchInfo(self, num=None):
+        url = XkcdClass.INFO_URL if num is None else self.COMIC_URL % num
+        with urllib.request.urlopen(url, timeout=self.TIMEOUT) as stream:
+            data = stream.read()
+        self.bytesTransferred += len(data)
+        return json.loads(data.decode())
+
+    def storeComic(self, info, img):
+        """Render a comic for the display and store the palettized frame."""
+        frame = palettize(formatComic(img, info["title"], self.display), self.display.colour, XkcdClass.QUANTIZE)
+        meta = {"num": info["num"], "title": info["title"], "date": "%s-%s-%s" % (info["year"], info["month"], info["day"]), "shown": 0}
+        storeFrame(self.cache, self.frameKey(info["num"]), frame, meta)
+
+    def fetchComic(self, num):
+        info = self._fetchInfo(num)
+        with urllib.request.urlopen(info["img"], timeout=self.TIMEOUT) as imgStream:
+            imgData = imgStream.read()
+        self.bytesTransferred += len(imgData)
+        resolution = self.display.resolution
+        img = loadComic(io.BytesIO(imgData), (resolution[0], resolution[1] - HEADER))
+        self.storeComic(info, img)
+        img.close()
+
+    def prefetch(self, latestNum=None):
+        """Fetch every missing candidate comic, then trim the archive to its budget.
+
+        Returns the numbers of the comics that were added.
+        """
+        if latestNum is None:
+            # Reuse what XkcdClass already knows about the latest comic
+            latest = self.cache.getJson("info.0.json", allowStale=True)
+            if latest is None:
+                latest = self._fetchInfo()
+            latestNum = latest["num"]
+
+        stored = set(self.comics())
+        added = []
+        # Oldest candidates first, so the latest comics are the most recently
+        # used entries and the last to be evicted
+        for num in reversed(self.candidates(latestNum)):
+            if num in stored:
+                # Still wanted, keep it away from the eviction end
+                self.cache.getPath(self.frameKey(num), allowStale=True)
+                continue
+            try:
+                self.fetchComic(num)
+                added.append(num)
+            except Exception as err:
+                # Interactive comics have no usable image, just skip them
+                print("ERR: Could not prefetch XKCD %i: %s" % (num, err))
+
+        evicted = self.cache.evict(self.budget, prefix=self.PREFIX)
+        if evicted:
+            print("Info: Evicted %i archived XKCD frames" % len(evicted))
+        return added
+
+    def start(self, latestNum=None):
+        """Prefetch in a background thread, returns the thread."""
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self.prefetch, args=(latestNum,), name="xkcd-prefetch", daemon=True)
+            self._thread.start()
+        return self._thread
+
+    def nextComic(self):
+        """The stored comic shown least recently (newest first among never shown ones)."""
+        comics = self.comics()
+        if not comics:
+            return None
+        return min(comics, key=lambda num: (self.cache.getMeta(self.frameKey(num)).get("shown", 0), -num))
+
+    def getFrame(self, num):
+        return loadFrame(self.cache, self.frameKey(num))
+
+    def showNext(self, now=None):
+        """Show the next stored comic. Returns its number, or None if the archive is empty."""
+        num = self.nextComic()
+        if num is None:
+            print("ERR: No archived XKCD to show")
+            return None
+        frame = self.getFrame(num)
+        meta = self.cache.getMeta(self.frameKey(num))
+        meta["shown"] = time.time() if now is None else now
+        self.cache.setMeta(self.frameKey(num), meta)
+
+        self.display.set_image(frame)
+        self.display.show()
+        return num
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Prefetch XKCD comics and rotate through them offline")
+    parser.add_argument("--prefetch", action="store_true", help="fetch missing comics into the archive")
+    parser.add_argument("--latest", type=int, default=XkcdArchiveClass.LATEST, help="how many of the latest comics to keep")
+    parser.add_argument("--random", type=int, default=0, help="how many random older comics to add")
+    parser.add_argument("--show", action="store_true", help="show the next archived comic")
+    args = parser.parse_args()
+
+    display = FrameGuardClass(InkyConnect("red"), CACHE)
+    archive = XkcdArchiveClass(display, latest=args.latest, randomSample=args.random)
+    if args.prefetch:
+        print("Added %s" % archive.prefetch())
+    if args.show:
+        archive.showNext()
@@ -1,3 +1,4 @@
+import io
 import os
 import time
 import json
@@ -8,8 +9,11 @@ from sys import exit
 # Import dependancies
 from PIL import Image, ImageDraw, ImageFont
 from font_fredoka_one import FredokaOne
-from inky import eeprom
-from inky import phat
+from inkyDisplay import InkyConnect
+from quantize import palettize
+from frameGuard import FrameGuardClass
+from stageTimer import NULL_TIMER
+from diskCache import getCache
 
 # Import secrets
 from secrets import Secrets
@@ -19,11 +23,134 @@ DEBUG = True
 
 # Other important values
 HEADER = 15
+# Bump whenever formatComic's output changes, so stored frames are rendered again
+RENDER_VERSION = 3
+# Most bytes a comic may take once decoded, the Pi Zero only has 512 MB
+MEMORY_CEILING = 64 * 1024 * 1024
+# Comics taller than this many display shapes (about 3.4 widths on the pHAT) only show their top part
+TALL_ASPECTS = 8
 
 # Get the current path
 PATH = os.path.dirname(__file__)
 CACHE = "/home/" + Secrets.username + "/.cache/Inky/"
 
+def frameKey(prefix, num, resolution, mode):
+    """Cache key of a rendered comic frame, unique per comic, resolution, quantize mode and renderer."""
+    return "%s%i-%ix%i-%s-v%i.png" % (prefix, num, resolution[0], resolution[1], mode, RENDER_VERSION)
+
+
+def storeFrame(cache, key, frame, meta=None):
+    """Save a palettized frame into the cache as a small PNG."""
+    frameData = io.BytesIO()
+    frame.save(frameData, "PNG", optimize=True)
+    cache.putBytes(key, frameData.getvalue(), meta=meta, kind="frame")
+
+
+def loadFrame(cache, key):
+    """Load a stored frame, or None if it isn't cached."""
+    path = cache.getPath(key, allowStale=True)
+    if path is None:
+        return None
+    frame = Image.open(path)
+    frame.load()
+    return frame
+
+
+def _limitRows(img, rows):
+    """Cut a not yet decoded image to its top rows, so only those get decoded.
+
+    Only non-interlaced PNGs decode top to bottom in a single tile, returns
+    False for anything else (or a Pillow this doesn't work on), which then
+    has to be decoded in full and cropped.
+    """
+    if img.format != "PNG" or img.info.get("interlace") or len(img.tile) != 1 or not hasattr(img, "_size"):
+        return False
+    # A plain tuple, older Pillow has no named tiles
+    decoder, extents, offset, args = tuple(img.tile[0])[:4]
+    img.tile = [(decoder, (0, 0, img.size[0], rows), offset, args)]
+    img._size = (img.size[0], rows)
+    return True
+
+
+def loadComic(source, box, timer=NULL_TIMER, ceiling=MEMORY_CEILING):
+    """Decode a comic only as large as it needs to be to fill box (width, height).
+
+    JPEGs are decoded at a reduced scale straight away (draft mode), other
+    formats are box-reduced right after decoding, so the one LANCZOS resize
+    in formatComic works on at most about twice the final size. Comics more
+    than TALL_ASPECTS box shapes tall are cropped to their top panels, which
+    stay readable instead of becoming a thin strip; PNGs skip decoding the
+    rest altogether.
+
+    A comic that would take more than ceiling bytes is decoded at the
+    smallest JPEG scale, or cut to the top rows that fit. Raises ValueError
+    only when neither is possible.
+    """
+    with timer.stage("asset load"):
+        img = Image.open(source)
+        (imgx, imgy) = img.size
+        cropy = min(imgy, int(TALL_ASPECTS * imgx * box[1] / box[0]))
+        quotient = max(imgx/box[0], cropy/box[1])
+        # Twice the target, so the final resample still has detail to work with
+        wanted = (max(1, int(2 * imgx/quotient)), max(1, int(2 * cropy/quotient)))
+        if img.format == "JPEG":
+            mode = "RGB" if img.mode == "RGB" else "L"
+            img.draft(mode, (wanted[0], wanted[1] * imgy // cropy))
+            if img.size[0] * img.size[1] * len(img.getbands()) > ceiling:
+                # Draft can't be undone, start over at libjpeg's smallest scale
+                img.close()
+                img = Image.open(source)
+                img.draft(mode, (1, 1))
+
+        # The decoded rows, plus the RGB copy of the kept ones for palette and other modes
+        decodeBytes = img.size[0] * len(img.getbands())
+        convertBytes = 0 if img.mode in ("L", "RGB") else img.size[0] * 3
+        rows = max(1, img.size[1] * cropy // imgy)
+        if (decodeBytes + convertBytes) * rows > ceiling:
+            rows = max(1, ceiling // (decodeBytes + convertBytes))
+            print("Info: %ix%i comic is too large to decode, showing its top %i rows" % (imgx, imgy, rows))
+        if rows < img.size[1] and not _limitRows(img, rows):
+            needed = decodeBytes * img.size[1] + convertBytes * rows
+            if needed > ceiling:
+                img.close()
+                raise ValueError("%ix%i comic needs %i MB to decode" % (imgx, imgy, needed // (1024 * 1024)))
+        img.load()
+
+    with timer.stage("resize"):
+        # Crop first, so only the kept rows are converted
+        if rows < img.size[1]:
+            img = img.crop((0, 0, img.size[0], rows))
+        # Palette images would be resized with NEAREST, and reduce needs L or RGB
+        if img.mode not in ("L", "RGB"):
+            img = img.convert("RGB")
+        factor = int(min(img.size[0] / wanted[0], img.size[1] / wanted[1]))
+        if factor >= 2:
+            img = img.reduce(factor)
+    return img
+
+
+def formatComic(img, title, display, timer=NULL_TIMER):
+    """Scale a comic into the display below a centered title line."""
+    with timer.stage("asset load"):
+        titleFont = ImageFont.truetype("DejaVuSans.ttf", 12)
+
+    # Determine scaling
+    (imgx, imgy) = img.size
+    quotient = max(imgx/display.resolution[0], imgy/(display.resolution[1]-HEADER))
+
+    # Scale and center image in display
+    with timer.stage("resize"):
+        scaledImg = img.resize((int(imgx/quotient), int(imgy/quotient)), Image.LANCZOS)
+        imgOut = Image.new("RGB", display.resolution, (255, 255, 255))
+        imgOut.paste(scaledImg, (int((display.resolution[0] - scaledImg.size[0])/2), int(HEADER + (display.resolution[1] - scaledImg.size[1])/2)))
+    with timer.stage("text draw"):
+        draw = ImageDraw.Draw(imgOut)
+        title = "XKCD - %s" % title
+        _, _, txtx, _ = draw.textbbox((0,0), title, font=titleFont)
+        draw.text((int((display.resolution[0] - txtx)/2), 0), title, display.BLACK, font=titleFont)
+    return imgOut
+
+
 class XkcdClass:
     TITLE = ""
     NUMBER = 0
@@ -33,20 +160,27 @@ class XkcdClass:
     YEAR = 0
     DISPLAY = None
 
-    def __init__(self):
-        self.refresh()
+    INFO_URL = "https://xkcd.com/info.0.json"
+    TIMEOUT = 10
+    FRAME_PREFIX = "xkcd/frames/"
+    # One of quantize.MODES, error diffusion keeps the most of the line art
+    QUANTIZE = "floyd-steinberg"
+    # Only the latest few frames are worth keeping
+    FRAME_BUDGET = 64 * 1024
 
-    def __init__(self, display):
+    def __init__(self, display=None, refresh=True):
         self.DISPLAY = display
-        self.refresh()
+        self.timer = NULL_TIMER
+        self.bytesTransferred = 0
+        self.cache = getCache(CACHE)
+        if refresh:
+            self.refresh()
 
 
     def refresh(self, force=False):
         # Try to open the cached info file
-        try:
-            xkcdInfoFid = open(os.path.join(CACHE, "info.0.json"), "r")
-            cachedInfo = json.load(xkcdInfoFid)
-            xkcdInfoFid.close()
+        cachedInfo = self.cache.getJson("info.0.json", allowStale=True)
+        if cachedInfo is not None:
             self.TITLE = cachedInfo["title"]
             self.NUMBER = cachedInfo["num"]
             self.IMG = cachedInfo["img"]
@@ -56,34 +190,40 @@ class XkcdClass:
             """if "%04i-%02i-%02i" % (self.YEAR, self.Month, self.DAY) is time.strftime("%Y-%m-%d", time.localtime()):
                  print("Most recent is already from today")
                  return"""
-        except:
+        else:
             print("ERR: Could not open cached file")
+            force = True
+
+        # Only trust the validators if the image they describe is still there
+        if self.cache.getPath("xkcd.png", allowStale=True) is None:
+            force = True
 
         # Try to fetch the online info file
         try:
-            xkcdUrl = urllib.request.Request("https://xkcd.com/info.0.json")
-            stream = urllib.request.urlopen(xkcdUrl)
-            currentJson = stream.read().decode()
-            stream.close()
-            currentInfo = json.loads(currentJson)
-            if currentInfo["num"] > self.NUMBER:
-                print("Info: Found a new XKCD from %02i/%02i/%02i" % (int(currentInfo["month"]), int(currentInfo["day"]), int(currentInfo["year"])))
+            xkcdUrl = urllib.request.Request(self.INFO_URL)
+            # Validators for the cached info file, sent back as a conditional request
+            meta = {} if force else self.cache.getMeta("info.0.json")
+            if meta.get("etag"):
+                xkcdUrl.add_header("If-None-Match", meta["etag"])
+            if meta.get("last_modified"):
+                xkcdUrl.add_header("If-Modified-Since", meta["last_modified"])
 
-                # Overwrite cached image
-                """ imgFid = open(os.path.join(CACHE, "xkcd.png"), "w")
-                imgStream = urllib.request.urlopen(currentInfo["img"])
-                imgFid.write(imgStream.read())
-                imgStream.close()
-                imgFid.close() """
-                urllib.request.urlretrieve(currentInfo["img"], os.path.join(CACHE, "xkcd.png"))
-
-                # Overwrite cached info
-                xkcdInfoFid = open(os.path.join(CACHE, "info.0.json"), "w")
-                xkcdInfoFid.write(currentJson)
-                xkcdInfoFid.close()
+            with urllib.request.urlopen(xkcdUrl, timeout=self.TIMEOUT) as stream:
+                currentJson = stream.read()
+                headers = stream.headers
+            self.bytesTransferred += len(currentJson)
+            currentInfo = json.loads(currentJson.decode())
+            meta = {"etag": headers.get("ETag"), "last_modified": headers.get("Last-Modified")}
+            if force or currentInfo["num"] > self.NUMBER:
+                print("Info: Found a new XKCD from %02i/%02i/%02i" % (int(currentInfo["month"]), int(currentInfo["day"]), int(currentInfo["year"])))
 
-                # Clean-up
-                urllib.request.urlcleanup()
+                # Overwrite cached image, then the info describing it
+                with urllib.request.urlopen(currentInfo["img"], timeout=self.TIMEOUT) as imgStream:
+                    self.bytesTransferred += self.cache.putStream("xkcd.png", imgStream, pinned=True)
+                self.cache.putBytes("info.0.json", currentJson, meta=meta, pinned=True, kind="json")
+            else:
+                # Remember the validators for the next conditional request
+                self.cache.setMeta("info.0.json", meta)
 
             self.TITLE = currentInfo["title"]
             self.NUMBER = currentInfo["num"]
@@ -91,6 +231,11 @@ class XkcdClass:
             self.DAY = currentInfo["day"]
             self.MONTH = currentInfo["month"]
             self.YEAR = currentInfo["year"]
+        except urllib.error.HTTPError as err:
+            if err.code == 304:
+                print("Info: XKCD is unchanged")
+            else:
+                print("ERR: Could not open URL (HTTP %i)" % err.code)
         except urllib.error.URLError:
             print("ERR: Could not open URL")
         except Exception as err:
@@ -98,49 +243,65 @@ class XkcdClass:
             traceback.print_exc()
 
     def getImage(self):
-        return open(os.path.join(CACHE, "xkcd.png"), "r")
+        return open(self.cache.getPath("xkcd.png", allowStale=True), "rb")
 
     def getFormattedImage(self):
-        titleFont = ImageFont.truetype("DejaVuSans.ttf", 12)
-
-        # Load image and determine scaling
-        img = Image.open(os.path.join(CACHE, "xkcd.png"))
-        (imgx, imgy) = img.size
-        quotient = max(imgx/display.resolution[0], imgy/(display.resolution[1]-HEADER))
-        (width, height) = (int(imgx/quotient), int(imgy/quotient))
-
-        # Scale and center image in display
-        scaledImg = img.resize((int(imgx/quotient), int(imgy/quotient)), Image.LANCZOS)
-        imgOut = Image.new("RGB", display.resolution, (255, 255, 255))
-        imgOut.paste(scaledImg, (int((display.resolution[0] - scaledImg.size[0])/2), int(HEADER + (display.resolution[1] - scaledImg.size[1])/2)))
-        draw = ImageDraw.Draw(imgOut)
-        title = "XKCD - %s" % self.TITLE
-        _, _, txtx, _ = draw.textbbox((0,0), title, font=titleFont)
-        draw.text((int((display.resolution[0] - txtx)/2), 0), title, display.BLACK, font=titleFont)
+        # Load the cached comic, only as large as the display needs
+        display = self.DISPLAY
+        img = loadComic(self.cache.getPath("xkcd.png", allowStale=True), (display.resolution[0], display.resolution[1] - HEADER), self.timer)
+        imgOut = formatComic(img, self.TITLE, self.DISPLAY, self.timer)
 
         # Clean-up & return
         img.close()
         return imgOut
 
+    def getFrame(self):
+        """Return the palettized frame of the current comic.
+
+        The frame only depends on the comic, the display resolution and the
+        renderer, so it is rendered once and then loaded from the cache.
+        """
+        key = frameKey(self.FRAME_PREFIX, self.NUMBER, self.DISPLAY.resolution, self.QUANTIZE)
+        with self.timer.stage("asset load"):
+            frame = loadFrame(self.cache, key)
+        if frame is not None:
+            return frame
+
+        img = self.getFormattedImage()
+        with self.timer.stage("quantize"):
+            frame = palettize(img, self.DISPLAY.colour, self.QUANTIZE)
+        storeFrame(self.cache, key, frame, {"num": self.NUMBER, "title": self.TITLE})
+        self.cache.evict(self.FRAME_BUDGET, prefix=self.FRAME_PREFIX)
+        return frame
+
+    def previousFrame(self):
+        """The stored frame of the newest earlier comic, or None."""
+        suffix = frameKey(self.FRAME_PREFIX, 0, self.DISPLAY.resolution, self.QUANTIZE)[len(self.FRAME_PREFIX) + 1:]
+        numbers = [int(key[len(self.FRAME_PREFIX):-len(suffix)]) for key in list(self.cache.entries) if key.startswith(self.FRAME_PREFIX) and key.endswith(suffix)]
+        numbers = [num for num in numbers if num != self.NUMBER]
+        if not numbers:
+            return None
+        return loadFrame(self.cache, frameKey(self.FRAME_PREFIX, max(numbers), self.DISPLAY.resolution, self.QUANTIZE))
+
     def displayImage(self):
         if self.DISPLAY is None:
             return
 
-        # Update display with image
-        display.set_image(self.getFormattedImage())
-        display.show()
+        # Update display with image, already paletized
+        try:
+            frame = self.getFrame()
+        except (ValueError, OSError) as err:
+            # Keep showing the last comic that could be rendered
+            print("ERR: Could not render XKCD: %s" % err)
+            frame = self.previousFrame()
+            if frame is None:
+                return
+        self.DISPLAY.set_image(frame)
+        self.DISPLAY.show()
 
 if __name__ == "__main__":
   # Connect to the Inky Display
-  _eeprom = eeprom.read_eeprom()
-  if _eeprom is None:
-    raise RuntimeError("No EEPROM detected! You must manually initialise your Inky board.")
-  elif _eeprom.display_variant != 11:
-    if DEBUG:
-      print("Found eeprom id " + _eeprom.display_variant)
-    raise RuntimeError("Display is not the expected variant")
-
-  display = phat.InkyPHAT_SSD1608("red")
+  display = FrameGuardClass(InkyConnect("red"), CACHE)
 
   # Initial boot, print the InkyPhat Logo
   try: